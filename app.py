@@ -14,6 +14,8 @@ from dotenv import load_dotenv
 import logging
 from PIL import Image
 
+from catalog import REGION_MAP, ProductCatalog
+
 load_dotenv()
 
 DATA_DIR = Path(__file__).parent / "data"
@@ -770,6 +772,8 @@ def render_pipeline():
                 from search import build_index
 
                 collection = build_index()
+                get_search_engine().reset()
+                st.cache_data.clear()
                 st.success(f"構築完了 — {collection.count()} 件")
 
 
@@ -789,73 +793,30 @@ def render_footer():
 import logging
 
 def index_ready() -> bool:
-    try:
-        from search import ensure_local_index
-        rebuilt = ensure_local_index()
-        if rebuilt:
-            st.cache_data.clear()
-        return True
-    except Exception as e:
-        st.session_state["init_error"] = str(e)
-        logging.error(f"[App] index_ready check failed: {e}")
-        return False
-
-
-# ─── Data Loading ───────────────────────────────────────
+    """
+    インデックスの準備状態。確認結果はプロセス内で共有し、ChromaDB を見に行くのは版が変わったときだけ。
+    版が変わった (再構築・ロールバック・復元) ときだけ検索エンジンと st.cache_data を捨てる。
+    """
+    from search import get_index_readiness
 
-@st.cache_data
+    readiness = get_index_readiness()
+    if readiness.check():
+        get_search_engine().reset()
+        st.cache_data.clear()
+    if not readiness.ready:
+        st.session_state["init_error"] = readiness.error
+        logging.error(f"[App] index_ready check failed: {readiness.error}")
+    return readiness.ready
 
-def get_product_group(product_name) -> str:
-    """製品名をシリーズやカテゴリでグルーピングする"""
-    if not product_name:
-        return ""
-    p = str(product_name).strip()
-    if not p:
-        return ""
-    
-    # シリーズ・カテゴリ定義
-    if "マイティ" in p:
-        return "マイティシリーズ"
-    if "カームドア" in p or "カーム" in p:  # カーム、カームドア
-        return "カームドアシリーズ"
-    if "ランニング" in p:
-        return "ランニングシリーズ"
-    if "サニティ" in p or "プレブース" in p or "トイレ" in p:
-        return "トイレブース"
-    if "移動壁" in p:
-        return "移動壁"
-    if "スライディング" in p:
-        return "スライディングドア"
-    if "間仕切" in p or "パーティション" in p:
-        return "間仕切・パーティション"
-        
-    return "その他"
 
+# ─── Data Loading ───────────────────────────────────────
 
 @st.cache_data
 def load_filter_options():
     """raw_data.jsonからフィルタリング用の選択肢を作成（地方・製品グルーピング付き）"""
-    REGION_MAP = {
-        "北海道": "北海道・東北",
-        "青森県": "北海道・東北", "岩手県": "北海道・東北", "宮城県": "北海道・東北",
-        "秋田県": "北海道・東北", "山形県": "北海道・東北", "福島県": "北海道・東北",
-        "茨城県": "関東", "栃木県": "関東", "群馬県": "関東",
-        "埼玉県": "関東", "千葉県": "関東", "東京都": "関東", "神奈川県": "関東",
-        "新潟県": "中部・北陸", "富山県": "中部・北陸", "石川県": "中部・北陸", "福井県": "中部・北陸",
-        "山梨県": "中部・北陸", "長野県": "中部・北陸", "岐阜県": "中部・北陸",
-        "静岡県": "東海", "愛知県": "東海", "三重県": "東海",
-        "滋賀県": "近畿", "京都府": "近畿", "大阪府": "近畿",
-        "兵庫県": "近畿", "奈良県": "近畿", "和歌山県": "近畿",
-        "鳥取県": "中国・四国", "島根県": "中国・四国", "岡山県": "中国・四国",
-        "広島県": "中国・四国", "山口県": "中国・四国",
-        "徳島県": "中国・四国", "香川県": "中国・四国", "愛媛県": "中国・四国", "高知県": "中国・四国",
-        "福岡県": "九州・沖縄", "佐賀県": "九州・沖縄", "長崎県": "九州・沖縄",
-        "熊本県": "九州・沖縄", "大分県": "九州・沖縄", "宮崎県": "九州・沖縄", "鹿児島県": "九州・沖縄", "沖縄県": "九州・沖縄",
-    }
-    
     raw_path = Path(__file__).parent / "data" / "raw_data.json"
     locations = set()
-    product_groups = set()
+    product_names = []
     
     if raw_path.exists():
         try:
@@ -864,12 +825,15 @@ def load_filter_options():
                 for item in data:
                     if item.get("location"):
                         locations.add(item["location"])
-                    for p in item.get("products", []):
-                        group = get_product_group(p)
-                        if group and group != "その他": # "その他"はリストに出さない方がきれいかも？いったん出すか。
-                            product_groups.add(group)
+                    product_names.extend(item.get("products", []))
         except Exception:
             pass
+
+    # 製品グループは現在の版のインデックス構築時に作った製品カタログから引く (なければ raw_data.json から作る)
+    from search import PRODUCT_CATALOG_PATH, artifact_path, read_active_index
+    catalog_path = artifact_path(PRODUCT_CATALOG_PATH, read_active_index())
+    catalog = ProductCatalog.load(catalog_path) or ProductCatalog.build(product_names)
+    product_groups = set(catalog.groups_present())
     
     # 地方ブロックグルーピング
     grouped_loc = {}
@@ -886,19 +850,16 @@ def load_filter_options():
     return grouped_loc, sorted_groups
 
 
-@st.cache_data(ttl=3600)  # 1時間キャッシュ
-def cached_get_all_items():
-    """全件取得結果をキャッシュ。起動後初回のみ ChromaDBにアクセスする。"""
-    from search import get_all_items
-    return get_all_items(n_results=300)
-
-
-@st.cache_data(ttl=3600)  # 1時間キャッシュ
-def cached_search(query: str):
-    """クエリ検索結果をキャッシュ。同じクエリには2回目以降 APIを叩かない。"""
-    from search import search as vector_search
-    return vector_search(query, n_results=300)
+@st.cache_resource
+def get_search_engine():
+    """全セッションで共有する検索エンジン。ChromaDBクライアントはプロセス内で1度だけ開く。"""
+    import sys
+    from search import IMPORT_SECONDS, SearchEngine
 
+    # コールドスタートの計測: search の読み込み時間と、重い SDK がまだ読み込まれていないこと
+    heavy = [m for m in ("chromadb", "google.generativeai") if m in sys.modules]
+    logging.info(f"[App] search の読み込み: {IMPORT_SECONDS * 1000:.0f} ms (読み込み済みの SDK: {heavy or 'なし'})")
+    return SearchEngine()
 
 
 @st.cache_data
@@ -1121,22 +1082,35 @@ def main():
         with c2:
             sel_products = st.multiselect("製品", products, placeholder="製品名を選択...")
 
-    # チェック
-    if not index_ready():
+    # 絞り込み条件は検索エンジン側で適用する
+    browse_prod = st.session_state.get("browse_product", "")
+    filters = {
+        "locations": sorted(sel_locations),
+        "product_groups": sorted(sel_products),
+        "product_group": browse_prod,
+    }
+    if not any(filters.values()):
+        filters = None
+
+    # チェック (1回のリランで1度だけ)
+    ready = index_ready()
+    if not ready:
         if "init_error" in st.session_state:
             st.error(f"⚠️ 初期化エラー (準備中): {st.session_state['init_error']}")
         render_pipeline()
         return
 
     mode_title = ""
+    engine = get_search_engine()
+    # 検索結果は順位付きリストのカーソルで受け取り、表示するページ分だけ説明文を取得する
+    ranked = {"cursor": None, "total": 0}
 
     try:
         if st.session_state["similar_query_id"]:
             with st.spinner("類似案件を探しています..."):
-                from search import get_similar_by_id
                 # 類似検索実行
                 sim_id = st.session_state["similar_query_id"]
-                results = get_similar_by_id(sim_id, n_results=100)
+                ranked = engine.similar_cursor(sim_id, n_results=100, filters=filters)
                     
                 # ケースマップからプロジェクト名を取得して表示
                 case_map = load_case_map()
@@ -1150,12 +1124,12 @@ def main():
                     st.rerun()
         elif query:
             with st.spinner(""):
-                results = cached_search(query)
+                ranked = engine.search_cursor(query, filters=filters)
                 mode_title = f"「{query}」"
         else:
             # Query is empty: Show ALL items
             with st.spinner("一覧を読み込み中…"):
-                results = cached_get_all_items()
+                ranked = engine.browse_cursor(filters=filters)
                 mode_title = "すべての施工事例"
 
     except Exception as e:
@@ -1165,43 +1139,31 @@ def main():
             st.code(traceback.format_exc(), language="python")
         else:
             st.info("詳細な情報はサイドバーの「デバッグモード」をONにすると確認できます。")
-        results = []
+        ranked = {"cursor": None, "total": 0}
         mode_title = "エラー発生"
 
-    # Filtering (共通)
-    if results:
-        # Python側でフィルタリング
-        filtered_results = []
-        browse_prod = st.session_state.get("browse_product", "")
-        for r in results:
-            if sel_locations and r.get("location") not in sel_locations:
-                continue
-            # 製品フィルタ（フォームからの選択）
-            if sel_products:
-                r_prods = (r.get("products") or "").split("、")
-                if not any(get_product_group(p) in sel_products for p in r_prods):
-                    continue
-            # サイドバーからの製品絞り込み
-            if browse_prod:
-                r_prods = (r.get("products") or "").split("、")
-                if not any(get_product_group(p) == browse_prod for p in r_prods):
-                    continue
-            filtered_results.append(r)
-
-        
-        total = len(filtered_results)
-        total_pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
-        page = st.session_state.get("page", 0)
-        page = max(0, min(page, total_pages - 1))  # Clamp
-        
-        start = page * PAGE_SIZE
-        display_results = filtered_results[start:start + PAGE_SIZE]
+    # 絞り込みで0件になった場合も「見つかりませんでした」を表示する
+    if ranked["total"] or filters:
+        page_data = {"results": [], "total": 0, "page": 0, "pages": 1, "start": 0}
+        if ranked["cursor"] is not None:
+            try:
+                page_data = engine.search_page(ranked["cursor"], st.session_state.get("page", 0), PAGE_SIZE)
+            except Exception:
+                st.error("🔍 検索結果の読み込み中にエラーが発生しました。もう一度検索してください。")
+                if st.session_state.get("debug_mode"):
+                    import traceback
+                    st.code(traceback.format_exc(), language="python")
+        total = page_data["total"]
+        total_pages = page_data["pages"]
+        page = page_data["page"]
+        start = page_data["start"]
+        display_results = page_data["results"]
         
         if display_results:
             # ヘッダー：件数表示
             st.markdown(f"""
 <div class="results-bar">
-<span class="r-count">{total}件中 {start+1}〜{min(start+PAGE_SIZE,total)}件表示</span>
+<span class="r-count">{total}件{"以上" if page_data.get("more") else ""}中 {start+1}〜{min(start+PAGE_SIZE,total)}件表示</span>
 <span class="r-query">{mode_title}</span>
 </div>
 """,
@@ -1251,7 +1213,7 @@ def main():
                 unsafe_allow_html=True,
             )
 
-    elif not index_ready():
+    elif not ready:
         render_pipeline()
 
     render_footer()
@@ -0,0 +1,198 @@
+"""
+一覧表示 (get_all_items) 用の、事例単位のブラウズ表。
+
+インデックス構築時に事例ごとに1行 (代表画像・地方・製品グループ・画像数・製品数) を作って npz に保存する。
+一覧表示はこの表を絞り込み条件ごとに1度だけ配列演算で絞り込み、以降は安定した順序でページを切り出すだけになる。
+絞り込みの意味は catalog.build_where と同じ (製品グループの条件は画像単位で判定する)。
+"""
+
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+from catalog import PRODUCT_GROUP_INDEX, PRODUCTS_SEPARATOR, REGION_MAP, get_region
+
+# 並べ替えのキー。いずれも同順位の中は case_id の降順 (新しい事例が先)。
+SORT_KEYS = ("case_id", "region", "product_group")
+REGION_ORDER = list(dict.fromkeys([*REGION_MAP.values(), "その他"]))
+
+
+def _case_number(case_id: str) -> int:
+    return int(case_id) if case_id.isdigit() else -1
+
+
+def _image_order(doc_id: str) -> list:
+    """ドキュメント ID ("case_id:ファイル名") の自然順のキー (3_2.jpg が 3_10.jpg より前)。"""
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part) for part in re.split(r"(\d+)", doc_id)]
+
+
+def build_browse_table(doc_ids: list[str], metadatas: list[dict]) -> dict:
+    """
+    コレクションの全ドキュメント (ID とメタデータ) から事例単位の表を作る。
+    事例内のドキュメントは画像ファイル名の順に並べるので、代表画像は collection.get の返す順序によらない。
+    """
+    cases = {}  # case_id -> 行
+    for doc_id, meta in zip(doc_ids, metadatas):
+        meta = meta or {}
+        case_id = meta.get("case_id", "")
+        row = cases.get(case_id)
+        if row is None:
+            location = meta.get("location", "")
+            row = cases[case_id] = {
+                "location": location,
+                "region": meta.get("region") or get_region(location),
+                "docs": [],
+                "products": set(),
+            }
+        row["docs"].append((doc_id, int(meta.get("product_group_mask", 0))))
+        row["products"].update(p for p in (meta.get("products") or "").split(PRODUCTS_SEPARATOR) if p)
+
+    for row in cases.values():
+        row["docs"].sort(key=lambda doc: _image_order(doc[0]))
+    order = sorted(cases, key=lambda c: (-_case_number(c), c))
+    doc_rows = [(i, doc_id, mask) for i, c in enumerate(order) for doc_id, mask in cases[c]["docs"]]
+    case_masks = [int(np.bitwise_or.reduce([m for _, m in cases[c]["docs"]])) for c in order]
+    return {
+        "case_ids": np.array(order),
+        "locations": np.array([cases[c]["location"] for c in order]),
+        "regions": np.array([cases[c]["region"] for c in order]),
+        "masks": np.array(case_masks, dtype=np.int64),
+        "n_images": np.array([len(cases[c]["docs"]) for c in order], dtype=np.int32),
+        "n_products": np.array([len(cases[c]["products"]) for c in order], dtype=np.int32),
+        "doc_ids": np.array([d for _, d, _ in doc_rows]),
+        "doc_cases": np.array([i for i, _, _ in doc_rows], dtype=np.int32),
+        "doc_masks": np.array([m for _, _, m in doc_rows], dtype=np.int64),
+    }
+
+
+def save_browse_table(table: dict, path: Path) -> None:
+    tmp_path = Path(str(path) + ".tmp.npz")
+    np.savez_compressed(tmp_path, **table)
+    os.replace(tmp_path, path)
+
+
+def load_browse_table(path: Path) -> dict | None:
+    if not Path(path).exists():
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return {key: data[key] for key in data.files}
+    except Exception as e:
+        logging.error(f"[BrowseTable] 読み込みに失敗しました: {e}")
+        return None
+
+
+class BrowseTable:
+    """読み込んだブラウズ表から、絞り込み・並べ替え済みの事例の並びを作ってページを切り出す。"""
+
+    def __init__(self, table: dict):
+        self.table = table
+        self._orders = {}  # (条件, 並べ替え) -> (事例番号, 代表ドキュメント位置)
+
+    def __len__(self) -> int:
+        return len(self.table["case_ids"])
+
+    def _doc_mask(self, filters: dict) -> np.ndarray:
+        """画像単位の条件 (製品グループ) と事例単位の条件 (所在地・地方) を満たすドキュメントの bool 配列。"""
+        t = self.table
+        keep = np.ones(len(t["doc_ids"]), dtype=bool)
+        case_keep = np.ones(len(t["case_ids"]), dtype=bool)
+        if filters.get("locations"):
+            case_keep &= np.isin(t["locations"], list(filters["locations"]))
+        if filters.get("regions"):
+            case_keep &= np.isin(t["regions"], list(filters["regions"]))
+        keep &= case_keep[t["doc_cases"]]
+        if filters.get("product_groups"):
+            bits = 0
+            for g in filters["product_groups"]:
+                if g in PRODUCT_GROUP_INDEX:
+                    bits |= 1 << PRODUCT_GROUP_INDEX[g]
+            keep &= (t["doc_masks"] & bits) != 0
+        if filters.get("product_group"):
+            group = filters["product_group"]
+            if group in PRODUCT_GROUP_INDEX:
+                keep &= (t["doc_masks"] & (1 << PRODUCT_GROUP_INDEX[group])) != 0
+            else:
+                keep[:] = False
+        return keep
+
+    def _sort_keys(self, sort: str) -> list[np.ndarray]:
+        """np.lexsort 用のキー (最後の要素が第1キー)。"""
+        t = self.table
+        n = len(t["case_ids"])
+        base = np.arange(n)  # 構築時の並び = case_id の降順
+        if sort == "case_id":
+            return [base]
+        if sort == "region":
+            rank = {r: i for i, r in enumerate(REGION_ORDER)}
+            return [base, np.array([rank.get(r, len(rank)) for r in t["regions"]])]
+        if sort == "product_group":
+            # 事例が含む最も番号の小さい製品グループ (製品なしは末尾)
+            masks = t["masks"]
+            lowest = np.where(masks > 0, np.log2(masks & -masks, where=masks > 0, out=np.zeros(n)), 64)
+            return [base, lowest]
+        raise ValueError(f"未対応の並べ替えです: {sort}")
+
+    def ordered(self, filters: dict | None = None, sort: str = "case_id"):
+        """条件に合う (事例番号, 代表ドキュメント位置) を表示順に返す。条件・並べ替えごとにキャッシュする。"""
+        key = (json.dumps(filters or {}, sort_keys=True, ensure_ascii=False), sort)
+        if key not in self._orders:
+            keep = self._doc_mask(filters or {})
+            docs = np.flatnonzero(keep)
+            # ドキュメントは事例ごとに画像ファイル名の順で並んでいるので、事例ごとの先頭が代表画像
+            cases, first = np.unique(self.table["doc_cases"][docs], return_index=True)
+            reps = docs[first]
+            order = np.lexsort([k[cases] for k in self._sort_keys(sort)])
+            self._orders[key] = (cases[order], reps[order])
+        return self._orders[key]
+
+    def hits(self, filters: dict | None = None, sort: str = "case_id") -> "BrowseHits":
+        """条件に合う事例を表示順に並べた、遅延評価のヒット列 (スライスした分だけ辞書を作る)。"""
+        cases, reps = self.ordered(filters, sort)
+        return BrowseHits(self.table, cases, reps)
+
+    def count(self, filters: dict | None = None) -> int:
+        return len(self.ordered(filters)[0])
+
+    def facet_counts(self) -> dict:
+        """地方ごと・製品グループごとの事例数 (構築時の全事例)。"""
+        t = self.table
+        regions, counts = np.unique(t["regions"], return_counts=True)
+        return {
+            "total": len(t["case_ids"]),
+            "regions": dict(zip(regions.tolist(), counts.tolist())),
+            "product_groups": {
+                g: int(((t["masks"] >> i) & 1).sum()) for g, i in PRODUCT_GROUP_INDEX.items()
+            },
+        }
+
+
+class BrowseHits:
+    """
+    BrowseTable.hits の戻り値。search_ids などが返すヒットのリストと同じく len とスライスができ、
+    スライスした範囲の {"id", "case_id", "distance"} だけを作るので、ページ送りはページの件数分の仕事で済む。
+    """
+
+    def __init__(self, table: dict, cases: np.ndarray, reps: np.ndarray):
+        self._case_ids = table["case_ids"]
+        self._doc_ids = table["doc_ids"]
+        self._cases = cases
+        self._reps = reps
+
+    def __len__(self) -> int:
+        return len(self._cases)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._hit(c, d) for c, d in zip(self._cases[index], self._reps[index])]
+        return self._hit(self._cases[index], self._reps[index])
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def _hit(self, case: int, doc: int) -> dict:
+        return {"id": str(self._doc_ids[doc]), "case_id": str(self._case_ids[case]), "distance": 0.0}
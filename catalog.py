@@ -0,0 +1,247 @@
+"""
+絞り込み用の分類 (地方ブロック・製品グループ) と製品カタログの定義。
+
+インデックス構築時に各ドキュメントのメタデータへ展開しておき、
+検索エンジン側 (Chroma の where / NumPy のマスク) で絞り込めるようにする。
+製品名は表記ゆれが多いので、正規化した表記 -> 正規製品ID -> 製品グループ の対応表 (ProductCatalog) を
+構築時に作って data/product_catalog.json に保存し、ドキュメントの製品グループはこの表から配列で求める。
+"""
+
+import json
+import logging
+import os
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from lexical_index import normalize
+
+UNIQUE_PRODUCTS_PATH = Path(__file__).parent / "unique_products.txt"
+PRODUCT_CATALOG_PATH = Path(__file__).parent / "data" / "product_catalog.json"
+
+REGION_MAP = {
+    "北海道": "北海道・東北",
+    "青森県": "北海道・東北", "岩手県": "北海道・東北", "宮城県": "北海道・東北",
+    "秋田県": "北海道・東北", "山形県": "北海道・東北", "福島県": "北海道・東北",
+    "茨城県": "関東", "栃木県": "関東", "群馬県": "関東",
+    "埼玉県": "関東", "千葉県": "関東", "東京都": "関東", "神奈川県": "関東",
+    "新潟県": "中部・北陸", "富山県": "中部・北陸", "石川県": "中部・北陸", "福井県": "中部・北陸",
+    "山梨県": "中部・北陸", "長野県": "中部・北陸", "岐阜県": "中部・北陸",
+    "静岡県": "東海", "愛知県": "東海", "三重県": "東海",
+    "滋賀県": "近畿", "京都府": "近畿", "大阪府": "近畿",
+    "兵庫県": "近畿", "奈良県": "近畿", "和歌山県": "近畿",
+    "鳥取県": "中国・四国", "島根県": "中国・四国", "岡山県": "中国・四国",
+    "広島県": "中国・四国", "山口県": "中国・四国",
+    "徳島県": "中国・四国", "香川県": "中国・四国", "愛媛県": "中国・四国", "高知県": "中国・四国",
+    "福岡県": "九州・沖縄", "佐賀県": "九州・沖縄", "長崎県": "九州・沖縄",
+    "熊本県": "九州・沖縄", "大分県": "九州・沖縄", "宮崎県": "九州・沖縄", "鹿児島県": "九州・沖縄", "沖縄県": "九州・沖縄",
+}
+
+# 製品グループ。並び順がメタデータのフラグ番号 (pg_0, pg_1, ...) とビットマスクのビット位置になるので、
+# 追加は末尾に行うこと。
+PRODUCT_GROUPS = [
+    "マイティシリーズ",
+    "カームドアシリーズ",
+    "ランニングシリーズ",
+    "トイレブース",
+    "移動壁",
+    "スライディングドア",
+    "間仕切・パーティション",
+    "その他",
+]
+PRODUCT_GROUP_INDEX = {g: i for i, g in enumerate(PRODUCT_GROUPS)}
+
+# どのドキュメントにも一致しない where 句 (product_group_mask は常に 0 以上)
+_NO_MATCH = {"product_group_mask": -1}
+
+# ドキュメントのメタデータ上で製品名を連結している区切り文字
+PRODUCTS_SEPARATOR = "、"
+
+
+def get_region(location: str) -> str:
+    return REGION_MAP.get(location, "その他")
+
+
+def get_product_group(product_name) -> str:
+    """製品名をシリーズやカテゴリでグルーピングする"""
+    if not product_name:
+        return ""
+    p = str(product_name).strip()
+    if not p:
+        return ""
+
+    # シリーズ・カテゴリ定義
+    if "マイティ" in p:
+        return "マイティシリーズ"
+    if "カームドア" in p or "カーム" in p:  # カーム、カームドア
+        return "カームドアシリーズ"
+    if "ランニング" in p:
+        return "ランニングシリーズ"
+    if "サニティ" in p or "プレブース" in p or "トイレ" in p:
+        return "トイレブース"
+    if "移動壁" in p:
+        return "移動壁"
+    if "スライディング" in p:
+        return "スライディングドア"
+    if "間仕切" in p or "パーティション" in p:
+        return "間仕切・パーティション"
+
+    return "その他"
+
+
+def load_unique_products(path: Path = UNIQUE_PRODUCTS_PATH) -> list[str]:
+    """unique_products.txt の製品名 (1行1件)。ファイルがなければ空。"""
+    if not Path(path).exists():
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class ProductCatalog:
+    """
+    正規化した製品名 -> 正規製品ID -> 製品グループ の対応表。
+    グループの判定 (get_product_group の文字列照合) は構築時に1度だけ行い、
+    検索時は製品IDから配列で引く。
+    """
+
+    def __init__(self, names: list[str], groups, aliases: dict[str, int]):
+        self.names = list(names)  # 製品ID -> 代表表記
+        self.groups = np.asarray(groups, dtype=np.int64)  # 製品ID -> PRODUCT_GROUPS の番号
+        self.aliases = aliases  # 正規化した表記 -> 製品ID
+        self._group_bits = np.left_shift(1, self.groups)
+
+    @classmethod
+    def build(cls, product_names: list[str]) -> "ProductCatalog":
+        """
+        製品名の出現をすべて並べたリストから作る。正規化して同じになる表記は1つの製品IDにまとめ、
+        最も多く使われている表記 (同数なら先に出たもの) を代表表記にする。
+        """
+        spellings = {}  # 正規化した表記 -> Counter(元の表記)
+        for name in product_names:
+            name = (name or "").strip()
+            key = normalize(name)
+            if key:
+                spellings.setdefault(key, Counter())[name] += 1
+        names, groups, aliases = [], [], {}
+        for key, counter in spellings.items():
+            aliases[key] = len(names)
+            name = counter.most_common(1)[0][0]
+            names.append(name)
+            groups.append(PRODUCT_GROUP_INDEX[get_product_group(name)])
+        return cls(names, groups, aliases)
+
+    def save(self, path: Path = PRODUCT_CATALOG_PATH) -> None:
+        tmp_path = Path(str(path) + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"names": self.names, "groups": self.groups.tolist(), "aliases": self.aliases},
+                f, ensure_ascii=False,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path = PRODUCT_CATALOG_PATH) -> "ProductCatalog | None":
+        if not Path(path).exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(data["names"], data["groups"], data["aliases"])
+        except Exception as e:
+            logging.error(f"[Catalog] 製品カタログの読み込みに失敗しました: {e}")
+            return None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def product_id(self, name: str) -> int | None:
+        return self.aliases.get(normalize(name))
+
+    def product_ids(self, names: list[str]) -> list[int]:
+        """カタログにある製品の ID を、重複を除いて出現順に返す。"""
+        ids = (self.product_id(name) for name in names)
+        return list(dict.fromkeys(i for i in ids if i is not None))
+
+    def group_mask(self, ids) -> int:
+        """製品IDの集合が属する製品グループのビットマスク。"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return 0
+        return int(np.bitwise_or.reduce(self._group_bits[ids]))
+
+    def groups_present(self) -> list[str]:
+        """カタログの製品が属する製品グループ (PRODUCT_GROUPS の順)。"""
+        return [PRODUCT_GROUPS[i] for i in np.unique(self.groups)]
+
+
+def product_group_flag(group: str) -> str:
+    """製品グループを表すメタデータのキー (pg_0 など)。"""
+    return f"pg_{PRODUCT_GROUP_INDEX[group]}"
+
+
+def facet_metadata(metadata: dict, product_catalog: ProductCatalog | None = None) -> dict:
+    """
+    location / products から、絞り込み用のメタデータ (地方・製品グループのフラグとビットマスク) を作る。
+    Chroma では where 句で pg_N フラグを、NumPy バックエンドでは product_group_mask を使う。
+    product_catalog を渡すと、カタログにある製品のグループは製品IDから配列で求める。
+    """
+    names = [p for p in (metadata.get("products") or "").split(PRODUCTS_SEPARATOR) if p]
+    mask = 0
+    if product_catalog is not None:
+        ids = product_catalog.product_ids(names)
+        mask = product_catalog.group_mask(ids)
+        # カタログにない表記だけ文字列照合でグループを求める
+        names = [p for p in names if product_catalog.product_id(p) is None]
+    for p in names:
+        group = get_product_group(p)
+        if group:
+            mask |= 1 << PRODUCT_GROUP_INDEX[group]
+    facets = {
+        "region": get_region(metadata.get("location", "")),
+        "product_group_mask": mask,
+    }
+    for group, i in PRODUCT_GROUP_INDEX.items():
+        facets[f"pg_{i}"] = bool(mask & (1 << i))
+    return facets
+
+
+def with_facets(metadata: dict) -> dict:
+    """絞り込み用メタデータを持たない古いドキュメント向けに、足りないキーを補う。"""
+    if "product_group_mask" in metadata and "region" in metadata:
+        return metadata
+    return {**metadata, **facet_metadata(metadata)}
+
+
+def build_where(filters: dict | None) -> dict | None:
+    """
+    検索条件を Chroma の where 句に変換する。
+    filters のキー:
+      locations      : 都道府県のいずれか
+      regions        : 地方ブロックのいずれか
+      product_groups : 製品グループのいずれかを含む
+      product_group  : この製品グループを必ず含む
+    """
+    if not filters:
+        return None
+    clauses = []
+    if filters.get("locations"):
+        clauses.append({"location": {"$in": list(filters["locations"])}})
+    if filters.get("regions"):
+        clauses.append({"region": {"$in": list(filters["regions"])}})
+    groups = [g for g in filters.get("product_groups") or [] if g in PRODUCT_GROUP_INDEX]
+    if filters.get("product_groups"):
+        flags = [{product_group_flag(g): True} for g in groups]
+        if not flags:
+            # 未知のグループだけが指定された場合は何にも一致させない
+            flags = [_NO_MATCH]
+        clauses.append(flags[0] if len(flags) == 1 else {"$or": flags})
+    if filters.get("product_group"):
+        group = filters["product_group"]
+        if group in PRODUCT_GROUP_INDEX:
+            clauses.append({product_group_flag(group): True})
+        else:
+            clauses.append(_NO_MATCH)
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
@@ -0,0 +1,100 @@
+"""
+Embedding の永続キャッシュ (SQLite)。
+
+キーは (モデル名, task_type, 出力次元, テキストのハッシュ)。
+インデックス再構築や同じクエリの再検索で Gemini API を呼ばずに済ませる。
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+from array import array
+from pathlib import Path
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """スレッドセーフな SQLite バックエンドの Embedding キャッシュ。"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    task_type TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, task_type, dim, text_hash)
+                )
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def get_many(
+        self, model: str, task_type: str, dim: int, texts: list[str]
+    ) -> list[list[float] | None]:
+        """texts と同じ順序で、キャッシュにあれば Embedding、なければ None を返す。"""
+        if not texts:
+            return []
+        hashes = [text_hash(t) for t in texts]
+        found = {}
+        try:
+            with self._lock:
+                conn = self._connect()
+                # SQLite のプレースホルダ上限を超えないよう分割して問い合わせる
+                for i in range(0, len(hashes), 500):
+                    chunk = hashes[i:i + 500]
+                    rows = conn.execute(
+                        "SELECT text_hash, vector FROM embeddings "
+                        "WHERE model = ? AND task_type = ? AND dim = ? "
+                        f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                        [model, task_type, dim, *chunk],
+                    ).fetchall()
+                    for h, blob in rows:
+                        found[h] = array("f", blob).tolist()
+        except sqlite3.Error as e:
+            logging.warning(f"[EmbeddingCache] read failed: {e}")
+            return [None] * len(texts)
+        return [found.get(h) for h in hashes]
+
+    def get(self, model: str, task_type: str, dim: int, text: str) -> list[float] | None:
+        return self.get_many(model, task_type, dim, [text])[0]
+
+    def put_many(
+        self, model: str, task_type: str, dim: int,
+        texts: list[str], vectors: list[list[float]],
+    ) -> None:
+        rows = [
+            (model, task_type, dim, text_hash(t), array("f", v).tobytes())
+            for t, v in zip(texts, vectors)
+        ]
+        if not rows:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            # キャッシュの書き込み失敗で検索や構築自体は止めない
+            logging.warning(f"[EmbeddingCache] write failed: {e}")
+
+    def put(self, model: str, task_type: str, dim: int, text: str, vector: list[float]) -> None:
+        self.put_many(model, task_type, dim, [text], [vector])
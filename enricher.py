@@ -11,6 +11,8 @@ from dotenv import load_dotenv
 import google.generativeai as genai
 from PIL import Image
 
+from product_matcher import ProductMatcher
+
 load_dotenv()
 
 DATA_DIR = Path(__file__).parent / "data"
@@ -100,6 +102,7 @@ def run_enricher() -> list[dict]:
         print(f"[Enricher] 処理中 ({i+1}/{len(raw_cases)}): {case['project_name']}")
         
         case_enriched = {**case, "descriptions": []}
+        matcher = ProductMatcher(case.get("products", []))
         
         # 既存の説明文があれば引き継ぐ (部分的な再開用)
         existing_descs = {}
@@ -126,9 +129,12 @@ def run_enricher() -> list[dict]:
                 )
                 time.sleep(2) # レート制限への配慮
 
-            case_enriched["descriptions"].append(
-                {"image_path": img_path, "description": description}
-            )
+            case_enriched["descriptions"].append({
+                "image_path": img_path,
+                "description": description,
+                # 説明文に現れる製品だけを画像ごとの製品とする (migrate_products.py と同じ照合)
+                "refined_products": matcher.find(description),
+            })
         
         enriched_list.append(case_enriched)
         
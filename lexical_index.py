@@ -0,0 +1,222 @@
+"""
+文字 n-gram による転置インデックス (語彙検索)。
+
+分かち書きしない日本語でも使えるよう、正規化したテキストを文字バイグラムに分解して索引する。
+製品名・案件名・所在地・説明文をフィールドごとに重み付けした BM25 でスコアを付け、
+ベクトル検索の結果と Reciprocal Rank Fusion で統合する (search.SearchEngine 参照)。
+"""
+
+import logging
+import os
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+NGRAM = 2
+
+# フィールドと重み。製品名・所在地・案件名は説明文より強く効かせる。
+FIELD_WEIGHTS = {
+    "products": 3.0,
+    "location": 3.0,
+    "project_name": 2.0,
+    "description": 1.0,
+}
+# フレーズ一致を判定するフィールド。クエリがそのまま製品名・地名なら、語彙検索だけで答えられる。
+# (案件名は「オフィス」「学校」のような雰囲気検索の語を含むので対象外)
+PHRASE_FIELDS = ("products", "location")
+PHRASE_MIN_LENGTH = 2
+# 製品名の一部への一致をフレーズ一致とみなす、製品名に占めるクエリの長さの割合の下限
+# (「ガラス」「ドア」のような製品名の一部でしかない語はベクトル検索に回す)
+PHRASE_MIN_COVERAGE = 0.8
+PRODUCTS_SEPARATOR = "、"
+# 所在地 (都道府県) は「京都」で「京都府」に一致させるため、末尾の都道府県を除いた名前でも照合する
+_PREFECTURE_SUFFIXES = ("都", "道", "府", "県")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 正規化で取り除く文字 (表記ゆれの多い区切り記号と空白)
+_STRIP_CHARS = str.maketrans("", "", " \t\r\n-‐－・/／")
+
+
+def normalize(text: str) -> str:
+    """NFKC 正規化・小文字化し、区切り記号と空白を取り除く。"""
+    return unicodedata.normalize("NFKC", text or "").lower().translate(_STRIP_CHARS)
+
+
+def _matches_product(q: str, text: str) -> bool:
+    return any(
+        q in name and len(q) >= PHRASE_MIN_COVERAGE * len(name)
+        for name in text.split(PRODUCTS_SEPARATOR)
+    )
+
+
+def _matches_location(q: str, text: str) -> bool:
+    return q == text or (text.endswith(_PREFECTURE_SUFFIXES) and q == text[:-1])
+
+
+def ngrams(text: str, n: int = NGRAM) -> list[str]:
+    """正規化済みテキストの文字 n-gram。n 文字未満ならテキスト全体を1つの gram とする。"""
+    if len(text) < n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+def rrf_fuse(rankings: list[list[str]], k: int = 60) -> dict[str, float]:
+    """複数のランキング (ID のリスト) を Reciprocal Rank Fusion で統合したスコアを返す。"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return scores
+
+
+class LexicalIndex:
+    """フィールドごとの CSR 形式 (gram -> ドキュメント番号・出現回数) の転置インデックス。"""
+
+    def __init__(self, doc_ids, vocab, fields: dict, phrase_texts: dict):
+        self.doc_ids = np.asarray(doc_ids)
+        self.vocab = {g: i for i, g in enumerate(vocab)}
+        # field -> (indptr, docs, tf, doc_len)
+        self.fields = fields
+        # field -> 正規化済みテキスト (フレーズ一致判定用)
+        self.phrase_texts = phrase_texts
+
+    @classmethod
+    def build(cls, docs: list[tuple[str, dict]]) -> "LexicalIndex":
+        """docs: (doc_id, {フィールド名: テキスト}) のリスト。"""
+        vocab = {}
+        postings = {field: {} for field in FIELD_WEIGHTS}
+        lengths = {field: np.zeros(len(docs), dtype=np.int32) for field in FIELD_WEIGHTS}
+        phrase_texts = {field: [] for field in PHRASE_FIELDS}
+
+        for d, (_, texts) in enumerate(docs):
+            for field in FIELD_WEIGHTS:
+                norm = normalize(texts.get(field, ""))
+                if field in phrase_texts:
+                    phrase_texts[field].append(norm)
+                grams = ngrams(norm)
+                lengths[field][d] = len(grams)
+                for gram, tf in Counter(grams).items():
+                    g = vocab.setdefault(gram, len(vocab))
+                    postings[field].setdefault(g, []).append((d, tf))
+
+        fields = {}
+        for field, by_gram in postings.items():
+            indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+            for g, plist in by_gram.items():
+                indptr[g + 1] = len(plist)
+            indptr = np.cumsum(indptr)
+            doc_arr = np.empty(indptr[-1], dtype=np.int32)
+            tf_arr = np.empty(indptr[-1], dtype=np.uint16)
+            for g, plist in by_gram.items():
+                start = indptr[g]
+                doc_arr[start:start + len(plist)] = [p[0] for p in plist]
+                tf_arr[start:start + len(plist)] = [min(p[1], 65535) for p in plist]
+            fields[field] = (indptr, doc_arr, tf_arr, lengths[field])
+
+        vocab_list = [None] * len(vocab)
+        for gram, g in vocab.items():
+            vocab_list[g] = gram
+        return cls(
+            doc_ids=[doc_id for doc_id, _ in docs],
+            vocab=vocab_list,
+            fields=fields,
+            phrase_texts={f: np.array(v) for f, v in phrase_texts.items()},
+        )
+
+    def save(self, path: Path) -> None:
+        arrays = {
+            "doc_ids": self.doc_ids,
+            "vocab": np.array(sorted(self.vocab, key=self.vocab.get)),
+        }
+        for field, (indptr, docs, tf, lengths) in self.fields.items():
+            arrays[f"{field}__indptr"] = indptr
+            arrays[f"{field}__docs"] = docs
+            arrays[f"{field}__tf"] = tf
+            arrays[f"{field}__len"] = lengths
+        for field, texts in self.phrase_texts.items():
+            arrays[f"{field}__text"] = texts
+        tmp_path = Path(str(path) + ".tmp.npz")
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "LexicalIndex | None":
+        if not Path(path).exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                fields = {
+                    field: (
+                        data[f"{field}__indptr"], data[f"{field}__docs"],
+                        data[f"{field}__tf"], data[f"{field}__len"],
+                    )
+                    for field in FIELD_WEIGHTS
+                }
+                phrase_texts = {field: data[f"{field}__text"] for field in PHRASE_FIELDS}
+                return cls(data["doc_ids"], data["vocab"].tolist(), fields, phrase_texts)
+        except Exception as e:
+            logging.error(f"[LexicalIndex] 読み込みに失敗しました: {e}")
+            return None
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def scores(self, query: str) -> np.ndarray:
+        """全ドキュメントに対するフィールド重み付き BM25 スコア。"""
+        n_docs = len(self.doc_ids)
+        scores = np.zeros(n_docs, dtype=np.float64)
+        grams = [self.vocab[g] for g in set(ngrams(normalize(query))) if g in self.vocab]
+        if not grams or n_docs == 0:
+            return scores
+        for field, weight in FIELD_WEIGHTS.items():
+            indptr, docs, tf, lengths = self.fields[field]
+            avg_len = max(lengths.mean(), 1.0)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_len)
+            for g in grams:
+                start, end = indptr[g], indptr[g + 1]
+                if start == end:
+                    continue
+                df = end - start
+                idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                d = docs[start:end]
+                t = tf[start:end].astype(np.float64)
+                scores[d] += weight * idf * t * (BM25_K1 + 1) / (t + norm[d])
+        return scores
+
+    def search(self, query: str, n_results: int, allowed: np.ndarray | None = None) -> list[tuple[str, float]]:
+        """(doc_id, スコア) をスコアの降順で返す。allowed は候補にする行の bool 配列。"""
+        scores = self.scores(query)
+        if allowed is not None:
+            scores = np.where(allowed, scores, 0.0)
+        hit = np.flatnonzero(scores > 0)
+        if len(hit) == 0:
+            return []
+        top = hit[np.argsort(-scores[hit], kind="stable")[:n_results]]
+        return [(str(self.doc_ids[i]), float(scores[i])) for i in top]
+
+    def phrase_matches(self, query: str) -> np.ndarray:
+        """
+        正規化したクエリ全体が、製品名そのもの (製品名の PHRASE_MIN_COVERAGE 以上を占める部分一致を含む) か、
+        所在地 (都道府県名。末尾の都道府県は省略可) に一致するドキュメントの bool 配列。
+        「京都」が「東京都」に一致するような、名前の途中への一致は含めない。
+        """
+        q = normalize(query)
+        matched = np.zeros(len(self.doc_ids), dtype=bool)
+        if len(q) < PHRASE_MIN_LENGTH:
+            return matched
+        n = len(matched)
+        matched |= np.fromiter(
+            (_matches_product(q, text) for text in self.phrase_texts["products"]), dtype=bool, count=n
+        )
+        matched |= np.fromiter(
+            (_matches_location(q, text) for text in self.phrase_texts["location"]), dtype=bool, count=n
+        )
+        return matched
+
+    def positions(self, doc_ids) -> np.ndarray:
+        """doc_ids に含まれるドキュメントの bool 配列 (絞り込み条件の適用用)。"""
+        return np.isin(self.doc_ids, np.asarray(list(doc_ids)))
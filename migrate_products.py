@@ -1,26 +1,8 @@
 import json
-import re
 
-ENRICHED_DATA_PATH = "data/enriched_data.json"
+from product_matcher import ProductMatcher, filter_products  # noqa: F401 (旧来の import 先)
 
-def filter_products(description, all_products):
-    refined_products = []
-    # Normalize description for better matching (optional)
-    desc_normalized = description.lower()
-    
-    for product in all_products:
-        # Simple inclusion check.
-        if product in description:
-            refined_products.append(product)
-            continue
-            
-        # Try a slightly more flexible match (remove hyphens)
-        prod_normalized = product.replace("-", "").replace(" ", "")
-        if prod_normalized in desc_normalized.replace("-", "").replace(" ", ""):
-             refined_products.append(product)
-
-    # Remove duplicates while preserving order
-    return list(dict.fromkeys(refined_products))
+ENRICHED_DATA_PATH = "data/enriched_data.json"
 
 def main():
     print(f"Loading {ENRICHED_DATA_PATH}...")
@@ -35,14 +17,15 @@ def main():
     total_images = 0
     
     for case in cases:
-        case_products = case.get("products", [])
+        # 事例の製品名でオートマトンを1度だけ組み立て、全画像の説明文に使い回す
+        matcher = ProductMatcher(case.get("products", []))
         
         for desc_entry in case.get("descriptions", []):
             total_images += 1
             description = desc_entry.get("description", "")
             
             # Calculate refined products
-            refined = filter_products(description, case_products)
+            refined = matcher.find(description)
             
             # Update the entry with new field
             desc_entry["refined_products"] = refined
@@ -0,0 +1,145 @@
+"""
+製品名 -> 事例 のポスティングリスト (製品名クエリの高速経路)。
+
+製品カタログ (unique_products.txt と各事例の products) の表記を正規化したものをキーに、
+その製品を使っている事例と、画像ごとの製品 (refined_products) に含む画像を引けるようにしておく。
+クエリが製品名そのもの (完全一致か、製品名の大部分を占める部分一致) なら、Embedding API を呼ばずにここから答える。
+「ガラス」「ドア」のように製品名の一部でしかない語や近似一致は、ベクトル検索の結果を押し上げるのにだけ使う。
+"""
+
+import difflib
+import json
+import logging
+import os
+from pathlib import Path
+
+from lexical_index import normalize
+
+# 部分一致を試すクエリの最小文字数 (正規化後)
+PRODUCT_MIN_QUERY = 2
+# 表記ゆれ・打ち間違いとみなす類似度の下限 (difflib の ratio)
+PRODUCT_FUZZY_CUTOFF = 0.8
+PRODUCT_FUZZY_MAX = 5
+# 部分一致を「製品名そのもの」とみなす、製品名に占めるクエリの長さの割合の下限
+PRODUCT_WHOLE_NAME_COVERAGE = 0.8
+
+
+class ProductIndex:
+    """正規化した製品名をキーにした事例のポスティングリスト。"""
+
+    def __init__(self, postings: dict, case_docs: dict):
+        # 製品キー -> [[case_id, 使用回数, [製品を写した画像のドキュメントID...]], ...]
+        self.postings = postings
+        # case_id -> 事例の全ドキュメントID (代表画像の選択用)
+        self.case_docs = case_docs
+        self._keys = list(postings)
+
+    @classmethod
+    def build(cls, cases: list[dict], doc_products: list[tuple[str, str, list[str]]],
+              catalog_names: list[str] | None = None) -> "ProductIndex":
+        """
+        cases: enriched_data.json の事例 (products に事例全体の製品名)。
+        doc_products: (doc_id, case_id, 画像ごとの製品名) のリスト。
+        catalog_names: 事例に現れない表記も含めた製品名の一覧 (キーだけ登録する)。
+        """
+        postings = {}
+        for name in catalog_names or []:
+            key = normalize(name)
+            if key:
+                postings.setdefault(key, {})
+
+        case_docs = {}
+        product_docs = {}  # (キー, case_id) -> 画像のドキュメントID
+        for doc_id, case_id, products in doc_products:
+            case_docs.setdefault(case_id, []).append(doc_id)
+            for name in dict.fromkeys(normalize(p) for p in products):
+                if name:
+                    product_docs.setdefault((name, case_id), []).append(doc_id)
+
+        for case in cases:
+            case_id = case.get("case_id", "")
+            if case_id not in case_docs:
+                continue
+            for name in case.get("products", []):
+                key = normalize(name)
+                if not key:
+                    continue
+                by_case = postings.setdefault(key, {})
+                by_case[case_id] = by_case.get(case_id, 0) + 1
+        # 事例側の products に無く、画像側にだけ現れる製品名も拾う
+        for key, case_id in product_docs:
+            postings.setdefault(key, {}).setdefault(case_id, 1)
+
+        return cls(
+            postings={
+                key: [[case_id, count, product_docs.get((key, case_id), [])] for case_id, count in by_case.items()]
+                for key, by_case in postings.items()
+            },
+            case_docs=case_docs,
+        )
+
+    def save(self, path: Path) -> None:
+        tmp_path = Path(str(path) + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"postings": self.postings, "case_docs": self.case_docs}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "ProductIndex | None":
+        if not Path(path).exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(data["postings"], data["case_docs"])
+        except Exception as e:
+            logging.error(f"[ProductIndex] 読み込みに失敗しました: {e}")
+            return None
+
+    def match(self, query: str) -> dict[str, float]:
+        """
+        クエリに一致する製品キーと重み (1.0 が完全一致)。
+        完全一致 > 部分一致 (クエリが製品名の一部) > 近似一致 の順に試し、最初に見つかった段階の結果を返す。
+        """
+        q = normalize(query)
+        if not q:
+            return {}
+        if q in self.postings:
+            return {q: 1.0}
+        if len(q) < PRODUCT_MIN_QUERY:
+            return {}
+        partial = {key: len(q) / len(key) for key in self._keys if q in key}
+        if partial:
+            return partial
+        close = difflib.get_close_matches(q, self._keys, n=PRODUCT_FUZZY_MAX, cutoff=PRODUCT_FUZZY_CUTOFF)
+        return {key: difflib.SequenceMatcher(None, q, key).ratio() for key in close}
+
+    def lookup(self, query: str, allowed: set[str] | None = None,
+               whole_name: bool = False) -> list[tuple[str, str, float]]:
+        """
+        (case_id, 代表ドキュメントID, スコア) をスコアの降順で返す。製品名に一致しなければ空。
+        スコアは一致した製品キーの重み x 事例内での使用回数の合計。
+        代表画像はその製品を写した画像を優先し、allowed (絞り込み後のドキュメントID) に含まれるものから選ぶ。
+        whole_name=True の場合は、製品名そのものへの一致 (重みが PRODUCT_WHOLE_NAME_COVERAGE 以上) だけを使う。
+        """
+        matches = self.match(query)
+        if whole_name:
+            # 近似一致 (difflib) の重みも 0.8 以上になりうるので、クエリを含むキーだけに限る
+            q = normalize(query)
+            matches = {key: w for key, w in matches.items() if q in key and w >= PRODUCT_WHOLE_NAME_COVERAGE}
+        scores = {}
+        preferred = {}
+        for key, weight in matches.items():
+            for case_id, count, doc_ids in self.postings[key]:
+                scores[case_id] = scores.get(case_id, 0.0) + weight * count
+                preferred.setdefault(case_id, []).extend(doc_ids)
+
+        results = []
+        for case_id, score in scores.items():
+            candidates = [*preferred[case_id], *self.case_docs.get(case_id, [])]
+            doc_id = next((d for d in candidates if allowed is None or d in allowed), None)
+            if doc_id is not None:
+                results.append((case_id, doc_id, score))
+        # スコアが同じ事例は登録順 (データの並び) のまま
+        results.sort(key=lambda r: -r[2])
+        return results
@@ -0,0 +1,73 @@
+"""
+説明文に現れる製品名を探す複数パターン照合 (Aho-Corasick)。
+
+製品名と説明文は lexical_index.normalize (NFKC・小文字化・区切り記号と空白の除去) で揃えてから照合するので、
+「マイティ-70」と「マイティ70」のような表記ゆれも一致する。
+説明文は1回だけ正規化し、1回の走査で全製品を見つける。
+"""
+
+from collections import deque
+
+from lexical_index import normalize
+
+
+class ProductMatcher:
+    """製品名のリストからオートマトンを組み立て、説明文に含まれる製品名を返す。"""
+
+    def __init__(self, products: list[str]):
+        self.products = list(products)
+        keys = {}  # 正規化した製品名 -> パターン番号
+        self._product_keys = []
+        for product in self.products:
+            key = normalize(product)
+            self._product_keys.append(keys.setdefault(key, len(keys)) if key else None)
+
+        # トライ: 各状態の遷移 (文字 -> 状態)・失敗リンク・その状態で一致するパターン番号
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        for key, pattern in keys.items():
+            state = 0
+            for ch in key:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                state = nxt
+            self._out[state].add(pattern)
+
+        # 幅優先で失敗リンクを張り、失敗先の出力を合流させる
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                if state == 0:
+                    continue  # 深さ1の状態の失敗先は根
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def find(self, description: str) -> list[str]:
+        """説明文に含まれる製品名を、コンストラクタに渡した順序で重複なく返す。"""
+        found = set()
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for ch in normalize(description):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+        matched = [p for p, key in zip(self.products, self._product_keys) if key is not None and key in found]
+        return list(dict.fromkeys(matched))
+
+
+def filter_products(description: str, all_products: list[str]) -> list[str]:
+    """all_products のうち description に現れるものを返す (1回だけ照合する場合の簡易版)。"""
+    return ProductMatcher(all_products).find(description)
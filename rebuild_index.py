@@ -1,6 +1,16 @@
-from search import build_index
+import sys
+
+from search import build_index, rollback_index
 
 if __name__ == "__main__":
-    print("Rebuilding index...")
-    build_index()
+    if "--rollback" in sys.argv:
+        # 1つ前の版に戻す (もう一度実行すると元の版に戻る)
+        active = rollback_index()
+        print(f"Rolled back to index version {active['version'] or '(legacy)'}: {active['collection']}")
+        sys.exit(0)
+    # 通常は差分更新。--full を付けるとコレクションを作り直して全件を再Embeddingする。
+    # どちらも新しい版を作って検証してから切り替えるので、構築中も検索は止まらない。
+    full = "--full" in sys.argv
+    print("Rebuilding index (full)..." if full else "Updating index...")
+    build_index(full=full)
     print("Index rebuilt successfully.")
@@ -1,14 +1,56 @@
 """
 ChromaDB + Gemini Embedding によるベクトル検索モジュール。
+
+chromadb と google.generativeai は読み込みに時間がかかる (それぞれ約1秒) ので、モジュールの先頭では読み込まず、
+ベクトル検索・Embedding・インデックス構築で初めて使う関数の中で import する。
+一覧表示 (browse) はブラウズ表とスナップショットの軽量な読み手 (SnapshotReader) だけで返せるので、どちらも読み込まない。
 """
 
+import time
+
+# 読み込み時間 (IMPORT_SECONDS) の起点。以降の import をすべて含めて計る。
+_import_started = time.perf_counter()
+
+import asyncio
+import hashlib
+import importlib
 import json
 import os
+import random
+import re
+import shutil
+import threading
+import unicodedata
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from dotenv import load_dotenv
-import chromadb
-import google.generativeai as genai
+import numpy as np
+
+from catalog import (
+    PRODUCT_CATALOG_PATH,
+    ProductCatalog,
+    build_where,
+    facet_metadata,
+    load_unique_products,
+    with_facets,
+)
+from browse_table import BrowseTable, build_browse_table, load_browse_table, save_browse_table
+from embedding_cache import EmbeddingCache
+from lexical_index import LexicalIndex, rrf_fuse
+from product_index import ProductIndex
+from similar_cases import (
+    SimilarCasesTable,
+    build_similar_cases,
+    load_similar_cases,
+    save_similar_cases,
+)
+
+if TYPE_CHECKING:
+    import chromadb
 
 load_dotenv()
 
@@ -17,29 +59,343 @@ ENRICHED_DATA_PATH = DATA_DIR / "enriched_data.json"
 CHROMA_DIR = DATA_DIR / "chroma_db_v2"
 
 COLLECTION_NAME = "komatsu_cases"
+# 青/緑切り替え: インデックス構築ごとに版を作り (コレクション komatsu_cases_v<版> と data/indexes/<版>/)、
+# 検証してから active_index.json (現在の版を指すポインタ) を差し替える。1つ前の版はロールバック用に残す。
+# ポインタがない古い構成では COLLECTION_NAME と data/ 直下のファイルをそのまま使う。
+INDEXES_DIR = DATA_DIR / "indexes"
+ACTIVE_INDEX_PATH = DATA_DIR / "active_index.json"
+INDEX_VALIDATION_QUERIES = 5  # 検証で自分自身が最近傍に返るか試すドキュメント数
 EMBEDDING_MODEL = "models/gemini-embedding-001"
+# Embedding の出力次元。0 = モデル既定 (gemini-embedding-001 は 3072)。
+# 256 / 768 / 1536 などを指定すると API に output_dimensionality として渡し、超過分は切り詰めて正規化し直す。
+# インデックスの次元はコレクションのメタデータに記録し、検索時にクエリの次元と照合する。
+EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "0"))
+DEFAULT_EMBEDDING_DIMENSION = 3072
+
+# Embedding の永続キャッシュ (キーの次元は EMBEDDING_DIMENSION)
+EMBEDDING_CACHE_PATH = DATA_DIR / "embedding_cache.sqlite3"
+
+# インデックス構築時のバッチ設定
+EMBED_BATCH_SIZE = 100  # batchEmbedContents 1リクエストあたりの最大件数
+CHROMA_ADD_BATCH_SIZE = 500
+# Embedding API のリクエスト数上限 (1分あたり)。APIのクォータに合わせて環境変数で調整する。
+EMBED_REQUESTS_PER_MINUTE = int(os.environ.get("EMBED_REQUESTS_PER_MINUTE", "100"))
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "4"))
+EMBED_MAX_RETRIES = 5
+# 非同期検索 (asearch) の Embedding API 同時リクエスト数とタイムアウト (秒)
+ASYNC_EMBED_CONCURRENCY = int(os.environ.get("ASYNC_EMBED_CONCURRENCY", "8"))
+QUERY_EMBED_TIMEOUT = float(os.environ.get("QUERY_EMBED_TIMEOUT", "10"))
+
+# 検索に使うベクトルバックエンド: "chroma" (HNSW) または "numpy" (エクスポートファイルを読み込んだ全件厳密検索)
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "chroma")
+EXPORT_PATH = DATA_DIR / "chroma_export.json"
+# 復元・NumPy バックエンド用のバイナリスナップショット (ベクトルは .npy を memmap で読む)。
+# 読めない場合は chroma_export.json にフォールバックする。
+SNAPSHOT_DIR = DATA_DIR / "snapshot"
+SNAPSHOT_FORMAT_VERSION = 1
+# NumPy バックエンドが検索に使うベクトルの形式: "float32" / "float16" / "int8" (ベクトルごとのスケール付き)。
+# 量子化した場合は上位 RERANK_FACTOR 倍の候補を float32 ベクトルで厳密に並べ直す (0 なら並べ直さない)。
+VECTOR_QUANTIZATION = os.environ.get("VECTOR_QUANTIZATION", "float32")
+RERANK_FACTOR = int(os.environ.get("RERANK_FACTOR", "4"))
+# 検索結果を事例単位にまとめるときのスコア: "best" (最も近い画像) / "mean_topk" (上位 CASE_TOP_K 枚の平均)
+CASE_AGGREGATION = os.environ.get("CASE_AGGREGATION", "best")
+CASE_TOP_K = 3
+# 文字 n-gram の語彙インデックス (ハイブリッド検索用) と RRF の定数
+LEXICAL_INDEX_PATH = DATA_DIR / "lexical_index.npz"
+RRF_K = 60
+# 製品名 -> 事例のポスティングリスト (製品名クエリを Embedding なしで答える)
+PRODUCT_INDEX_PATH = DATA_DIR / "product_index.json"
+# 事例単位の近傍グラフ (More Like This 用)
+SIMILAR_CASES_PATH = DATA_DIR / "similar_cases.npz"
+# 事例単位の一覧表 (代表画像・並べ替えキー・件数。全件表示のページ送り用)
+BROWSE_TABLE_PATH = DATA_DIR / "browse_table.npz"
+# ページング用に保持しておく順位付きリスト (カーソル) の数
+RANKING_CACHE_SIZE = 128
+# 順位付きリストを作り直すための条件を覚えておくカーソルの数 (リストより軽いので多めに持つ)
+CURSOR_SPEC_CACHE_SIZE = 1024
+# 検索のカーソルが最初に順位を求める事例数。search_page がその先のページを求めたら倍に広げる。
+SEARCH_CURSOR_WINDOW = 300
 
 
 import logging
 
-def _rebuild_from_export(client) -> None:
-    """chroma_export.json からコレクションを再構築する共通ヘルパー。"""
-    EXPORT_PATH = DATA_DIR / "chroma_export.json"
+def embedding_dimension() -> int:
+    """このプロセスの設定で作られる Embedding の次元。"""
+    return EMBEDDING_DIMENSION or DEFAULT_EMBEDDING_DIMENSION
+
+
+def collection_metadata(dimension: int | None = None) -> dict:
+    """
+    コレクション作成時のメタデータ (距離関数と、Embedding のモデル・次元)。
+    dimension を省略すると、このプロセスの設定で作られる次元 (embedding_dimension) を記録する。
+    """
+    return {
+        "hnsw:space": "cosine",
+        "embedding_model": EMBEDDING_MODEL,
+        "embedding_dimension": dimension or embedding_dimension(),
+    }
+
+
+def read_active_index() -> dict | None:
+    """
+    現在の版のポインタ {"version", "collection", "count", "dimension", "activated_at", "previous"}。
+    ポインタがない (版を使う前の構成) 場合は None。
+    """
+    if not ACTIVE_INDEX_PATH.exists():
+        return None
+    try:
+        with open(ACTIVE_INDEX_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logging.error(f"[Search] {ACTIVE_INDEX_PATH.name} の読み込みに失敗しました: {e}")
+        return None
+
+
+def active_collection_name(active: dict | None = None) -> str:
+    return active["collection"] if active else COLLECTION_NAME
+
+
+def artifact_path(path: Path, active: dict | None = None) -> Path:
+    """data/ 直下の成果物 (語彙インデックスやスナップショット等) の、指定した版での置き場所。"""
+    if not active or not active.get("version"):
+        return path
+    return INDEXES_DIR / active["version"] / path.name
+
+
+def _write_active_index(pointer: dict) -> None:
+    tmp_path = ACTIVE_INDEX_PATH.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(pointer, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, ACTIVE_INDEX_PATH)
+
+
+def _index_entry(active: dict | None) -> dict:
+    """ポインタから previous を除いた版の情報。ポインタがない古い構成は version=None の版として扱う。"""
+    if not active:
+        return {"version": None, "collection": COLLECTION_NAME}
+    return {k: v for k, v in active.items() if k != "previous"}
+
+
+def _load_export_records() -> list[dict] | None:
     if not EXPORT_PATH.exists():
         logging.error("[Search] 復元用ファイルが見つかりません。検索は利用できません。")
-        return
+        return None
+    with open(EXPORT_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _normalize_rows(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize_vectors(vectors, mode: str):
+    """
+    正規化済みベクトルを量子化して (符号, スケール) を返す。
+    int8 はベクトルごとに max|v| / 127 をスケールにした対称量子化、float16 はスケールなし (None)。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if mode == "float16":
+        return vectors.astype(np.float16), None
+    if mode == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0 if len(vectors) else np.empty(0, dtype=np.float32)
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"未対応の量子化形式です: {mode}")
+
+
+def write_snapshot(data: dict, snapshot_dir: Path | None = None) -> int:
+    """
+    collection.get(include=["documents", "metadatas", "embeddings"]) の結果をスナップショットとして書き出す。
+    ベクトルは float32 の .npy (Chroma への復元と厳密な並べ直し用)、VECTOR_QUANTIZATION が int8 なら
+    正規化して int8 に量子化した .npy も書き、ID・説明文・メタデータは列ごとの JSON (table) にまとめる。
+    ファイル名に世代を付けて書き、最後に manifest.json を置き換えることで読み手には常に完全な世代だけが見える。
+    snapshot_dir を省略すると現在の版のスナップショットに書く。
+    """
+    snapshot_dir = snapshot_dir or artifact_path(SNAPSHOT_DIR, read_active_index())
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    token = f"{time.time_ns():x}"
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    if vectors.ndim != 2:
+        vectors = vectors.reshape(len(data["ids"]), 0)  # 0 件
+
+    keys = list(dict.fromkeys(k for m in data["metadatas"] for k in (m or {})))
+    table = {
+        "ids": list(data["ids"]),
+        "documents": list(data["documents"]),
+        # メタデータは列ごとに持つ (キーを行ごとに繰り返さない)。欠けている値は None。
+        "columns": {k: [(m or {}).get(k) for m in data["metadatas"]] for k in keys},
+    }
+    vectors_name = f"vectors-{token}.npy"
+    table_name = f"table-{token}.json"
+    np.save(snapshot_dir / vectors_name, vectors)
+    names = [vectors_name, table_name]
+    int8 = None
+    if VECTOR_QUANTIZATION == "int8":
+        # int8 で検索する設定のときだけ量子化済みの配列も書く (読み込み時の量子化を省く)
+        int8 = {"codes": f"int8-{token}.npy", "scales": f"scales-{token}.npy"}
+        codes, scales = quantize_vectors(_normalize_rows(vectors), "int8")
+        np.save(snapshot_dir / int8["codes"], codes)
+        np.save(snapshot_dir / int8["scales"], scales)
+        names += int8.values()
+    with open(snapshot_dir / table_name, "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False)
+
+    manifest = {
+        "version": SNAPSHOT_FORMAT_VERSION,
+        "count": len(table["ids"]),
+        "dim": int(vectors.shape[1]) if len(vectors) else 0,
+        "dtype": str(vectors.dtype),
+        "vectors": vectors_name,
+        "table": table_name,
+        "int8": int8,
+    }
+    tmp_path = snapshot_dir / "manifest.json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, snapshot_dir / "manifest.json")
+
+    # 参照されなくなった古い世代を消す
+    for path in snapshot_dir.glob("*-*.*"):
+        if path.name not in names:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+    return manifest["count"]
+
+
+def _read_snapshot_table(snapshot_dir: Path) -> tuple[dict, dict] | None:
+    """スナップショットの manifest と table (ID・説明文・列ごとのメタデータ)。ない・形式が違う場合は None。"""
+    manifest_path = snapshot_dir / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SNAPSHOT_FORMAT_VERSION:
+        logging.warning(f"[Search] スナップショットの形式が異なります: {manifest.get('version')}")
+        return None
+    with open(snapshot_dir / manifest["table"], "r", encoding="utf-8") as f:
+        table = json.load(f)
+    if len(table["ids"]) != manifest["count"]:
+        raise ValueError("件数が manifest と一致しません")
+    return manifest, table
+
+
+def _table_metadatas(table: dict) -> list[dict]:
+    columns = table["columns"]
+    return [
+        {k: values[i] for k, values in columns.items() if values[i] is not None}
+        for i in range(len(table["ids"]))
+    ]
+
+
+def load_snapshot(snapshot_dir: Path | None = None) -> dict | None:
+    """
+    スナップショットを読み込み、{"ids", "documents", "metadatas", "embeddings"} を返す。
+    embeddings は memmap した (件数, 次元) の配列。int8 量子化ベクトルがあれば "int8": (符号, スケール) も付ける。
+    スナップショットがない・形式が違う場合は None。snapshot_dir を省略すると現在の版のものを読む。
+    """
+    snapshot_dir = snapshot_dir or artifact_path(SNAPSHOT_DIR, read_active_index())
     try:
-        with open(EXPORT_PATH, "r", encoding="utf-8") as f:
-            records = json.load(f)
+        snapshot = _read_snapshot_table(snapshot_dir)
+        if snapshot is None:
+            return None
+        manifest, table = snapshot
+        vectors = np.load(snapshot_dir / manifest["vectors"], mmap_mode="r")
+        if vectors.shape[0] != manifest["count"]:
+            raise ValueError("件数が manifest と一致しません")
+        int8 = None
+        if manifest.get("int8"):
+            int8 = (
+                np.load(snapshot_dir / manifest["int8"]["codes"], mmap_mode="r"),
+                np.load(snapshot_dir / manifest["int8"]["scales"]),
+            )
+    except Exception as e:
+        logging.error(f"[Search] スナップショットの読み込みに失敗しました: {e}")
+        return None
+
+    return {
+        "ids": table["ids"],
+        "documents": table["documents"],
+        "metadatas": _table_metadatas(table),
+        "embeddings": vectors,
+        "int8": int8,
+    }
+
+
+class SnapshotReader:
+    """
+    スナップショットの ID・説明文・メタデータだけを読む軽量な読み手 (ベクトルは読まず、chromadb も使わない)。
+    一覧表示の説明文・メタデータの取得に、Chroma の Collection.get と同じ形で答える。
+    """
+
+    def __init__(self, ids: list[str], documents: list[str], metadatas: list[dict]):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self._pos = {doc_id: i for i, doc_id in enumerate(ids)}
+
+    @classmethod
+    def open(cls, snapshot_dir: Path | None = None) -> "SnapshotReader | None":
+        snapshot_dir = snapshot_dir or artifact_path(SNAPSHOT_DIR, read_active_index())
+        try:
+            snapshot = _read_snapshot_table(snapshot_dir)
+        except Exception as e:
+            logging.error(f"[Search] スナップショットの読み込みに失敗しました: {e}")
+            return None
+        if snapshot is None:
+            return None
+        _, table = snapshot
+        return cls(table["ids"], table["documents"], _table_metadatas(table))
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def get(self, ids: list[str], include: list[str] = ("documents", "metadatas")) -> dict:
+        positions = [self._pos[doc_id] for doc_id in ids if doc_id in self._pos]
+        result = {"ids": [self.ids[i] for i in positions]}
+        if "documents" in include:
+            result["documents"] = [self.documents[i] for i in positions]
+        if "metadatas" in include:
+            result["metadatas"] = [self.metadatas[i] for i in positions]
+        return result
+
+
+def load_index_data(snapshot_dir: Path | None = None) -> dict | None:
+    """スナップショット、なければ chroma_export.json から、collection.get と同じ形のデータを読む。"""
+    data = load_snapshot(snapshot_dir)
+    if data is not None:
+        return data
+    records = _load_export_records()
+    if records is None:
+        return None
+    return {
+        "ids": [str(r["id"]) for r in records],
+        "documents": [r["document"] for r in records],
+        "metadatas": [r["metadata"] for r in records],
+        "embeddings": [r["embedding"] for r in records],
+    }
+
+
+def _rebuild_from_export(client) -> None:
+    """スナップショット (なければ chroma_export.json) から現在の版のコレクションを再構築する共通ヘルパー。"""
+    try:
+        data = load_index_data()
+        if data is None:
+            return
+        embeddings = data["embeddings"]
         col = client.get_or_create_collection(
-            name=COLLECTION_NAME,
-            metadata={"hnsw:space": "cosine"},
+            name=active_collection_name(read_active_index()),
+            metadata=collection_metadata(len(embeddings[0]) if len(embeddings) else None),
         )
-        ids = [str(r["id"]) for r in records]
-        documents = [r["document"] for r in records]
-        metadatas = [r["metadata"] for r in records]
-        embeddings = [r["embedding"] for r in records]
-        batch_size = 200
+        ids = data["ids"]
+        documents = data["documents"]
+        metadatas = [with_facets(m) for m in data["metadatas"]]
+        batch_size = CHROMA_ADD_BATCH_SIZE
         for i in range(0, len(ids), batch_size):
             col.add(
                 ids=ids[i:i+batch_size],
@@ -47,13 +403,239 @@ def _rebuild_from_export(client) -> None:
                 metadatas=metadatas[i:i+batch_size],
                 embeddings=embeddings[i:i+batch_size],
             )
-        logging.info(f"[Search] {len(records)}件のデータを正常に復元しました。")
+        logging.info(f"[Search] {len(ids)}件のデータを正常に復元しました。")
     except Exception as rebuild_e:
         logging.error(f"[Search] Restore failed: {rebuild_e}")
 
 
+def export_index(data: dict) -> int:
+    """
+    collection.get(include=["documents", "metadatas", "embeddings"]) の結果を
+    chroma_export.json に書き出す (現在の版の復元用。スナップショットは版ごとに build_index が書く)。
+    """
+    records = [
+        {
+            "id": doc_id,
+            "document": document,
+            "metadata": metadata,
+            "embedding": [float(x) for x in embedding],
+        }
+        for doc_id, document, metadata, embedding in zip(
+            data["ids"], data["documents"], data["metadatas"], data["embeddings"]
+        )
+    ]
+    tmp_path = EXPORT_PATH.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False)
+    os.replace(tmp_path, EXPORT_PATH)
+    return len(records)
+
+
+class NumpyIndex:
+    """
+    全ベクトルを行列としてメモリに載せ、行列積でコサイン top-k を返すバックエンド。
+    ChromaDB の Collection と同じ形 (count / query / get) の結果を返すので、SearchEngine からは区別なく使える。
+    行数が多い場合はブロックごとに行列積を取り、argpartition で各ブロックの上位だけを残す。
+
+    quantization が "float16" / "int8" のときは量子化したベクトルで候補を出し、
+    上位 rerank_factor 倍の候補だけを元の float32 ベクトル (スナップショットなら memmap) で厳密に並べ直す。
+    """
+
+    BLOCK_SIZE = 16384
+    CAST_ROWS = 256  # 量子化ベクトルを float32 に展開する単位 (256 行 × 768 次元で約 0.8MB)
+
+    def __init__(self, ids: list[str], documents: list[str], metadatas: list[dict], embeddings,
+                 quantization: str | None = None, rerank_factor: int | None = None, int8=None):
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self.metadatas = [with_facets(m) for m in metadatas]
+        self.quantization = quantization or VECTOR_QUANTIZATION
+        self.rerank_factor = RERANK_FACTOR if rerank_factor is None else rerank_factor
+        if self.quantization == "float32":
+            self.vectors = _normalize_rows(embeddings)
+            self._scales = None
+            self._raw = self._norms = None
+        else:
+            # 元のベクトルは並べ直し用に保持する (memmap ならメモリには載らない)
+            self._raw = embeddings if isinstance(embeddings, np.ndarray) else np.asarray(embeddings, dtype=np.float32)
+            self._norms = np.linalg.norm(self._raw, axis=1)
+            self._norms[self._norms == 0] = 1.0
+            if self.quantization == "int8" and int8 is not None:
+                self.vectors, self._scales = np.asarray(int8[0]), np.asarray(int8[1])
+            else:
+                self.vectors, self._scales = quantize_vectors(self._raw / self._norms[:, None], self.quantization)
+        # Chroma の Collection.metadata と同じ形で次元を公開する
+        self.metadata = {"hnsw:space": "cosine", "embedding_dimension": int(self.vectors.shape[1])}
+        self._pos = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self._columns = {}
+        self._masks = {}
+
+    @classmethod
+    def from_export(cls, snapshot_dir: Path | None = None) -> "NumpyIndex":
+        data = load_index_data(snapshot_dir)
+        if not data or not data["ids"]:
+            raise RuntimeError("インデックスが未構築です。先にインデックスを構築してください。")
+        return cls(data["ids"], data["documents"], data["metadatas"], data["embeddings"], int8=data.get("int8"))
+
+    @property
+    def quantized(self) -> bool:
+        return self.quantization != "float32"
+
+    def _exact(self, positions) -> np.ndarray:
+        """正規化した float32 ベクトル (量子化していればその行だけ元のベクトルから求める)。"""
+        positions = np.asarray(positions, dtype=np.int64)
+        if not self.quantized:
+            return self.vectors[positions]
+        return np.asarray(self._raw[positions], dtype=np.float32) / self._norms[positions, None]
+
+    def _block_sims(self, q: np.ndarray, block_rows: np.ndarray, start: int, contiguous: bool) -> np.ndarray:
+        """
+        クエリとブロック内の行の類似度 (量子化していれば近似値)。
+        量子化したベクトルは CAST_ROWS 行ずつ使い回しのバッファに float32 で展開してから行列積を取るので、
+        ブロック全体の float32 コピーは作らない。
+        """
+        end = start + len(block_rows)
+        if not self.quantized:
+            block = self.vectors[start:end] if contiguous else self.vectors[block_rows]
+            return q @ block.T
+        sims = np.empty((q.shape[0], len(block_rows)), dtype=np.float32)
+        buffer = np.empty((min(self.CAST_ROWS, len(block_rows)), self.vectors.shape[1]), dtype=np.float32)
+        for s in range(0, len(block_rows), self.CAST_ROWS):
+            m = min(self.CAST_ROWS, len(block_rows) - s)
+            rows = self.vectors[start + s:start + s + m] if contiguous else self.vectors[block_rows[s:s + m]]
+            np.copyto(buffer[:m], rows, casting="unsafe")
+            np.matmul(q, buffer[:m].T, out=sims[:, s:s + m])
+        if self._scales is not None:
+            sims *= self._scales[start:end] if contiguous else self._scales[block_rows]
+        return sims
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def _column(self, key: str):
+        """メタデータの1キー分を (値の一覧, 各行の値番号) に符号化してキャッシュする。"""
+        if key not in self._columns:
+            values = {}
+            codes = np.array(
+                [values.setdefault(m.get(key), len(values)) for m in self.metadatas],
+                dtype=np.int32,
+            )
+            self._columns[key] = (values, codes)
+        return self._columns[key]
+
+    def _eval_where(self, where: dict) -> np.ndarray:
+        """Chroma の where 句 ($and / $or / $in / $eq) を、行ごとの bool 配列として評価する。"""
+        masks = []
+        for key, cond in where.items():
+            if key in ("$and", "$or"):
+                sub = [self._eval_where(w) for w in cond]
+                masks.append(np.logical_and.reduce(sub) if key == "$and" else np.logical_or.reduce(sub))
+                continue
+            values, codes = self._column(key)
+            if isinstance(cond, dict) and "$in" in cond:
+                wanted = [values[v] for v in cond["$in"] if v in values]
+                masks.append(np.isin(codes, wanted))
+            else:
+                value = cond["$eq"] if isinstance(cond, dict) else cond
+                masks.append(codes == values[value] if value in values else np.zeros(len(codes), dtype=bool))
+        return np.logical_and.reduce(masks)
+
+    def where_mask(self, where: dict | None) -> np.ndarray | None:
+        """where 句に一致する行の bool 配列 (同じ条件は再計算しない)。where が空なら None。"""
+        if not where:
+            return None
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        if key not in self._masks:
+            self._masks[key] = self._eval_where(where)
+        return self._masks[key]
+
+    def _rows(self, positions, include) -> dict:
+        result = {"ids": [self.ids[i] for i in positions]}
+        if "documents" in include:
+            result["documents"] = [self.documents[i] for i in positions]
+        if "metadatas" in include:
+            result["metadatas"] = [self.metadatas[i] for i in positions]
+        if "embeddings" in include:
+            result["embeddings"] = self._exact(list(positions))
+        return result
+
+    def topk(self, query_embeddings, n_results: int, mask: np.ndarray | None = None):
+        """
+        各クエリについて (行番号, コサイン距離) の配列を距離の昇順で返す。
+        mask を渡すと、その行だけを候補にする。
+        """
+        q = np.asarray(query_embeddings, dtype=np.float32)
+        q_norms = np.linalg.norm(q, axis=1, keepdims=True)
+        q_norms[q_norms == 0] = 1.0
+        q = q / q_norms
+
+        rows = np.arange(self.vectors.shape[0]) if mask is None else np.flatnonzero(mask)
+        n = len(rows)
+        k = min(n_results, n)
+        best_idx = np.empty((q.shape[0], 0), dtype=np.int64)
+        best_sim = np.empty((q.shape[0], 0), dtype=np.float32)
+        if k == 0:
+            return best_idx, best_sim
+        rerank = self.quantized and self.rerank_factor > 0
+        if rerank:
+            final_k, k = k, min(k * self.rerank_factor, n)
+        for start in range(0, n, self.BLOCK_SIZE):
+            block_rows = rows[start:start + self.BLOCK_SIZE]
+            sims = self._block_sims(q, block_rows, start, contiguous=mask is None)
+            kb = min(k, sims.shape[1])
+            part = np.argpartition(-sims, kb - 1, axis=1)[:, :kb]
+            best_idx = np.concatenate([best_idx, block_rows[part]], axis=1)
+            best_sim = np.concatenate([best_sim, np.take_along_axis(sims, part, axis=1)], axis=1)
+            if best_idx.shape[1] > k:
+                keep = np.argpartition(-best_sim, k - 1, axis=1)[:, :k]
+                best_idx = np.take_along_axis(best_idx, keep, axis=1)
+                best_sim = np.take_along_axis(best_sim, keep, axis=1)
+
+        if rerank:
+            # 量子化ベクトルで選んだ候補だけを float32 で計算し直して上位 final_k 件に絞る
+            best_sim = np.stack([
+                self._exact(cand) @ q_row for cand, q_row in zip(best_idx, q)
+            ]).astype(np.float32)
+            keep = np.argpartition(-best_sim, final_k - 1, axis=1)[:, :final_k]
+            best_idx = np.take_along_axis(best_idx, keep, axis=1)
+            best_sim = np.take_along_axis(best_sim, keep, axis=1)
+
+        order = np.argsort(-best_sim, axis=1, kind="stable")
+        best_idx = np.take_along_axis(best_idx, order, axis=1)
+        distances = 1.0 - np.take_along_axis(best_sim, order, axis=1)
+        return best_idx, distances
+
+    def query(self, query_embeddings, n_results: int, where: dict | None = None,
+              include=("documents", "metadatas", "distances")) -> dict:
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if n_results <= 0 or not self.ids:
+            return result
+        best_idx, distances = self.topk(query_embeddings, n_results, mask=self.where_mask(where))
+        for positions, dists in zip(best_idx, distances):
+            rows = self._rows(positions, include)
+            result["ids"].append(rows["ids"])
+            result["documents"].append(rows.get("documents"))
+            result["metadatas"].append(rows.get("metadatas"))
+            result["distances"].append(dists.tolist())
+        return result
+
+    def get(self, ids=None, where=None, limit=None, include=("documents", "metadatas")) -> dict:
+        if ids is not None:
+            positions = [self._pos[i] for i in ids if i in self._pos]
+        else:
+            positions = range(len(self.ids))
+        mask = self.where_mask(where)
+        if mask is not None:
+            positions = [i for i in positions if mask[i]]
+        if limit is not None:
+            positions = positions[:limit]
+        return self._rows(positions, include)
+
+
 def get_chroma_client():
     """安全にChromaDBクライアントを取得する。エラー時は自動修復を試みる。"""
+    import chromadb
+
     try:
         client = chromadb.PersistentClient(path=str(CHROMA_DIR))
         # 疎通確認: list_collectionsが通ればOK (Rust panic対策)
@@ -77,17 +659,28 @@ def get_chroma_client():
 
     # クライアント作成は成功したが、コレクションが存在しない場合（初回デプロイ等）
     existing_names = [c.name for c in client.list_collections()]
-    if COLLECTION_NAME not in existing_names:
-        logging.info("[Search] コレクションが存在しません。chroma_export.json から再構築します。")
+    if active_collection_name(read_active_index()) not in existing_names:
+        logging.info("[Search] コレクションが存在しません。スナップショットから再構築します。")
         _rebuild_from_export(client)
 
     return client
 
 def ensure_local_index() -> bool:
     """初期化チェック用 (app.pyから呼ばれる)"""
+    active = read_active_index()
+    # 一覧表示はスナップショットとブラウズ表だけで返せるので、ここでは ChromaDB を開かない
+    # (コレクションがなければ、最初のベクトル検索で get_chroma_client がスナップショットから復元する)
+    snapshot_ready = (artifact_path(SNAPSHOT_DIR, active) / "manifest.json").exists()
+    if snapshot_ready and artifact_path(BROWSE_TABLE_PATH, active).exists():
+        return False
+    if VECTOR_BACKEND == "numpy":
+        if not (artifact_path(SNAPSHOT_DIR, active) / "manifest.json").exists() and not EXPORT_PATH.exists():
+            raise RuntimeError("インデックスが未構築です。先にインデックスを構築してください。")
+        return False
+
     client = get_chroma_client()
     try:
-        col = client.get_collection(COLLECTION_NAME)
+        col = client.get_collection(active_collection_name(active))
         if col.count() > 0:
             return False # すでに正常（再構築不要）
     except Exception:
@@ -98,57 +691,458 @@ def ensure_local_index() -> bool:
     return True
 
 
+def index_marker() -> tuple:
+    """
+    インデックスの版の目印。版のポインタと復元用ファイルの更新時刻で、stat だけなので毎回呼んでも安い。
+    再構築・ロールバック (別プロセスでのものも含む) のたびに変わる。
+    """
+    return tuple(path.stat().st_mtime_ns if path.exists() else 0 for path in (ACTIVE_INDEX_PATH, EXPORT_PATH))
+
+
+class IndexReadiness:
+    """
+    プロセス内で共有するインデックスの準備状態。
+    ensure_local_index (クライアントを開いて件数を数える) は版の目印が変わったときだけ呼び、
+    それ以外は前回の結果を返す。準備ができていない間は呼ばれるたびに確認し直す。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._marker = None
+        self.ready = False
+        self.error = None
+
+    def check(self) -> bool:
+        """状態を必要なら確認し直し、前回の確認から版が変わった (または復元した) 場合に True を返す。"""
+        marker = index_marker()
+        if self.ready and marker == self._marker:
+            return False
+        with self._lock:
+            if self.ready and marker == self._marker:
+                return False
+            changed = self._marker is not None and marker != self._marker
+            try:
+                changed = ensure_local_index() or changed
+                self.ready, self.error = True, None
+            except Exception as e:
+                self.ready, self.error = False, str(e)
+            # 復元でファイルが書き直されることがあるので、確認した後の目印を覚えておく
+            self._marker = index_marker()
+            return changed
+
+
+_readiness = IndexReadiness()
+
+
+def get_index_readiness() -> IndexReadiness:
+    return _readiness
+
+
+def open_vector_backend(backend: str = None, active: dict | None = None):
+    """設定に応じて、指定した版 (省略時は現在の版) の ChromaDB のコレクション、または NumpyIndex を開く。"""
+    backend = backend or VECTOR_BACKEND
+    active = active or read_active_index()
+    if backend == "numpy":
+        return NumpyIndex.from_export(artifact_path(SNAPSHOT_DIR, active))
+    if backend != "chroma":
+        raise ValueError(f"未対応のベクトルバックエンドです: {backend}")
+    client = get_chroma_client()
+    name = active_collection_name(active)
+    existing = [c.name for c in client.list_collections()]
+    if name not in existing:
+        raise RuntimeError("インデックスが未構築です。先にインデックスを構築してください。")
+    return client.get_collection(name)
+
+
+def index_dimension(collection) -> int | None:
+    """
+    コレクションに記録された Embedding の次元。記録のない古いコレクションは保存済みベクトルから求める。
+    空のコレクションなら None。
+    """
+    dim = (getattr(collection, "metadata", None) or {}).get("embedding_dimension")
+    if dim:
+        return int(dim)
+    sample = collection.get(limit=1, include=["embeddings"])
+    embeddings = sample.get("embeddings")
+    if embeddings is None or len(embeddings) == 0:
+        return None
+    return len(embeddings[0])
+
+
+_embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+
+
 def configure_api():
     api_key = os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
     if not api_key:
         raise ValueError(
             "GOOGLE_API_KEY または GEMINI_API_KEY 環境変数を設定してください。"
         )
+    import google.generativeai as genai
+
     genai.configure(api_key=api_key)
 
 
+def get_embedding_cache() -> EmbeddingCache:
+    return _embedding_cache
+
+
+def fit_dimension(vectors: list[list[float]], dimension: int | None = None) -> list[list[float]]:
+    """
+    dimension が指定されていれば、それより長いベクトルを先頭 dimension 次元に切り詰めて正規化し直す
+    (gemini-embedding-001 は Matryoshka 学習なので先頭次元だけでも使える)。
+    API に output_dimensionality を渡した場合も、縮めた出力は正規化されていないので同様に正規化する。
+    """
+    dimension = EMBEDDING_DIMENSION if dimension is None else dimension
+    if not dimension or not vectors:
+        return vectors
+    v = np.asarray(vectors, dtype=np.float32)[:, :dimension]
+    norms = np.linalg.norm(v, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (v / norms).tolist()
+
+
+def _embed_content(texts: list[str], task_type: str) -> list[list[float]]:
+    """Embedding API を1回呼ぶ。EMBEDDING_DIMENSION が指定されていれば出力次元も指定する。"""
+    import google.generativeai as genai
+
+    kwargs = {"output_dimensionality": EMBEDDING_DIMENSION} if EMBEDDING_DIMENSION else {}
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=texts,
+        task_type=task_type,
+        **kwargs,
+    )
+    return fit_dimension(result["embedding"])
+
+
 def get_embedding(text: str) -> list[float]:
+    return get_embeddings([text])[0]
+
+def get_embeddings(texts: list[str], task_type: str = "retrieval_document") -> list[list[float]]:
+    """
+    複数テキストを1リクエストでまとめて Embedding する。
+    キャッシュ済みのテキストは API に送らず、新たに得た Embedding はキャッシュに保存する。
+    """
+    if not texts:
+        return []
+    cached = _embedding_cache.get_many(EMBEDDING_MODEL, task_type, EMBEDDING_DIMENSION, texts)
+    missing = [i for i, v in enumerate(cached) if v is None]
+    if not missing:
+        return cached
+    missing_texts = [texts[i] for i in missing]
     try:
-        result = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=text,
-            task_type="retrieval_document",
-        )
-        return result["embedding"]
+        fresh = _embed_content(missing_texts, task_type)
     except Exception as e:
-        logging.error(f"[Search] Embedding creation failed: {e}")
+        logging.error(f"[Search] Batch embedding failed ({len(missing_texts)} texts): {e}")
         raise e
+    _embedding_cache.put_many(EMBEDDING_MODEL, task_type, EMBEDDING_DIMENSION, missing_texts, fresh)
+    for i, vector in zip(missing, fresh):
+        cached[i] = vector
+    return cached
 
-def get_query_embedding(text: str) -> list[float]:
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    """429 / クォータ超過系のエラーかどうか。"""
+    if getattr(e, "code", None) == 429:
+        return True
+    msg = str(e).lower()
+    return "429" in msg or "quota" in msg or "resource has been exhausted" in msg
+
+
+class TokenBucket:
+    """
+    全ワーカーで共有するトークンバケット型レートリミッタ。
+    429/クォータエラーを受けると補充レートを半分に落とし、成功が続くと元のレートまで戻す。
+    """
+
+    def __init__(self, requests_per_minute: int, capacity: int | None = None):
+        self.max_rate = max(1, requests_per_minute) / 60.0  # tokens / sec
+        self.rate = self.max_rate
+        self.capacity = capacity or max(1, min(10, requests_per_minute // 6))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, cooldown: float | None = None) -> None:
+        """レート制限を受けたときに呼ぶ。全ワーカーをしばらく止め、レートを下げる。"""
+        with self._lock:
+            now = time.monotonic()
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self._tokens = 0.0
+            self._updated = now
+            self._blocked_until = max(self._blocked_until, now + (cooldown or 1.0 / self.rate))
+
+    def reward(self) -> None:
+        """成功時に呼ぶ。下げたレートを少しずつ元に戻す。"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、後から来た呼び出しはその完了を待って同じ結果を受け取る。
+    人気のクエリに同時に多数のセッションが来ても、Embedding API の呼び出しは1回で済む。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # キー -> (完了イベント, [結果, 例外])
+
+    def do(self, key, fn):
+        """fn() を実行して結果を返す。同じ key が実行中なら、その結果を待って返す。戻り値は (結果, 合流したか)。"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = (threading.Event(), [None, None])
+        done, outcome = call
+        if not leader:
+            done.wait()
+            if outcome[1] is not None:
+                raise outcome[1]
+            return outcome[0], True
+        try:
+            outcome[0] = fn()
+        except BaseException as e:
+            outcome[1] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            done.set()
+        return outcome[0], False
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight の asyncio 版。同じイベントループで同じキーのコルーチンが実行中なら、その完了を待って同じ結果を受け取る。
+    呼び出し元がキャンセルされても他の呼び出し元が待っていれば処理は続け、誰も待たなくなったら取り消す。
+    """
+
+    def __init__(self):
+        self._calls = {}  # (イベントループ, キー) -> [タスク, 待っている呼び出し元の数]
+
+    async def do(self, key, fn):
+        """fn() のコルーチンを実行して結果を返す。同じ key が実行中なら、その結果を待って返す。戻り値は (結果, 合流したか)。"""
+        call_key = (asyncio.get_running_loop(), key)
+        call = self._calls.get(call_key)
+        shared = call is not None
+        if not shared:
+            call = self._calls[call_key] = [asyncio.ensure_future(fn()), 0]
+            call[0].add_done_callback(lambda _: self._calls.pop(call_key, None))
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0]), shared
+        except asyncio.CancelledError:
+            if call[1] == 1:
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+
+def embed_with_retry(
+    texts: list[str],
+    limiter: TokenBucket,
+    task_type: str = "retrieval_document",
+    max_retries: int = EMBED_MAX_RETRIES,
+) -> list[list[float]]:
+    """レートリミッタ経由でバッチ Embedding を行い、失敗時は指数バックオフでリトライする。"""
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            embeddings = get_embeddings(texts, task_type=task_type)
+            limiter.reward()
+            return embeddings
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            backoff = min(60.0, 2.0 ** attempt) + random.uniform(0, 1.0)
+            if _is_rate_limit_error(e):
+                limiter.penalize(cooldown=backoff)
+            else:
+                time.sleep(backoff)
+            logging.warning(f"[Search] Embedding retry {attempt + 1}/{max_retries} after error: {e}")
+
+
+def embed_concurrently(
+    texts: list[str],
+    task_type: str = "retrieval_document",
+    batch_size: int = EMBED_BATCH_SIZE,
+    workers: int = EMBED_WORKERS,
+    limiter: TokenBucket | None = None,
+):
+    """
+    texts をバッチに分け、スレッドプールで並行して Embedding する。
+    (texts 内の位置のリスト, それらの Embedding) を yield する。キャッシュ済みの分は最初にまとめて返し、
+    残りは API にバッチで送って入力順に返す。リトライしても失敗したバッチは例外を送出する。
+    """
+    cached = _embedding_cache.get_many(EMBEDDING_MODEL, task_type, EMBEDDING_DIMENSION, texts)
+    hits = [i for i, v in enumerate(cached) if v is not None]
+    if hits:
+        yield hits, [cached[i] for i in hits]
+    missing = [i for i, v in enumerate(cached) if v is None]
+    if not missing:
+        return
+
+    configure_api()
+    limiter = limiter or TokenBucket(EMBED_REQUESTS_PER_MINUTE)
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [
+            executor.submit(embed_with_retry, [texts[i] for i in batch], limiter, task_type)
+            for batch in batches
+        ]
+        try:
+            for batch, future in zip(batches, futures):
+                yield batch, future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def get_query_embeddings(texts: list[str]) -> list[list[float]]:
+    """
+    検索クエリをまとめて Embedding する。キャッシュにないクエリだけを EMBED_BATCH_SIZE 件ずつのバッチで API に送る。
+    空のクエリにはゼロベクトルを返す。
+    """
     try:
-        # 特殊な文字や空文字のガード
-        if not text or not text.strip():
-             # 空のクエリなら適当なベクトルを返すか、エラーにする
-             # ここでは空文字検索は上位で弾かれるはずだが一応
-             return [0.0] * 768
-
-        result = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=text,
-            task_type="retrieval_query",
-        )
-        return result["embedding"]
+        # 特殊な文字や空文字のガード (空文字検索は上位で弾かれるはずだが一応)
+        embeddings = [None if t and t.strip() else [0.0] * embedding_dimension() for t in texts]
+        non_empty = [i for i, v in enumerate(embeddings) if v is None]
+        for start in range(0, len(non_empty), EMBED_BATCH_SIZE):
+            chunk = non_empty[start:start + EMBED_BATCH_SIZE]
+            vectors = get_embeddings([texts[i] for i in chunk], task_type="retrieval_query")
+            for i, vector in zip(chunk, vectors):
+                embeddings[i] = vector
+        return embeddings
     except Exception as e:
         logging.error(f"[Search] Query embedding failed: {e}")
         # 詳細なエラー情報を付与して再送
         raise RuntimeError(f"Google Gemini Embedding Error: {str(e)}")
 
 
-def build_index() -> chromadb.Collection:
-    configure_api()
+def get_query_embedding(text: str) -> list[float]:
+    return get_query_embeddings([text])[0]
 
-    client = chromadb.PersistentClient(path=str(CHROMA_DIR))
 
-    existing = [c.name for c in client.list_collections()]
-    if COLLECTION_NAME in existing:
-        print(f"[Search] 既存コレクションを削除して再構築します。")
-        client.delete_collection(COLLECTION_NAME)
+# イベントループごとのセマフォ (asyncio.Semaphore は作られたループでしか使えない)
+_async_embed_semaphores = weakref.WeakKeyDictionary()
+
+
+def _async_embed_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _async_embed_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _async_embed_semaphores[loop] = asyncio.Semaphore(ASYNC_EMBED_CONCURRENCY)
+    return semaphore
+
+
+async def aget_query_embeddings(texts: list[str], timeout: float | None = None) -> list[list[float]]:
+    """
+    get_query_embeddings の asyncio 版。API への同時リクエスト数は ASYNC_EMBED_CONCURRENCY までに抑え、
+    1リクエストが timeout 秒 (省略時は QUERY_EMBED_TIMEOUT) を超えたら RuntimeError にする。
+    """
+    timeout = QUERY_EMBED_TIMEOUT if timeout is None else timeout
+    embeddings = [None if t and t.strip() else [0.0] * embedding_dimension() for t in texts]
+    non_empty = [i for i, v in enumerate(embeddings) if v is None]
+    # キャッシュ (SQLite) の読み書きと SDK の import はブロックするので、イベントループの外で行う
+    cached = await asyncio.to_thread(
+        _embedding_cache.get_many,
+        EMBEDDING_MODEL, "retrieval_query", EMBEDDING_DIMENSION, [texts[i] for i in non_empty],
+    )
+    missing = []
+    for i, vector in zip(non_empty, cached):
+        if vector is None:
+            missing.append(i)
+        else:
+            embeddings[i] = vector
+    if not missing:
+        return embeddings
+
+    genai = await asyncio.to_thread(importlib.import_module, "google.generativeai")
+    kwargs = {"output_dimensionality": EMBEDDING_DIMENSION} if EMBEDDING_DIMENSION else {}
+    for start in range(0, len(missing), EMBED_BATCH_SIZE):
+        chunk = missing[start:start + EMBED_BATCH_SIZE]
+        chunk_texts = [texts[i] for i in chunk]
+        try:
+            async with _async_embed_semaphore():
+                result = await asyncio.wait_for(
+                    genai.embed_content_async(
+                        model=EMBEDDING_MODEL,
+                        content=chunk_texts,
+                        task_type="retrieval_query",
+                        request_options={"timeout": timeout},
+                        **kwargs,
+                    ),
+                    timeout=timeout,
+                )
+        except asyncio.TimeoutError:
+            logging.error(f"[Search] Query embedding timed out after {timeout}s")
+            raise RuntimeError(f"Google Gemini Embedding Error: {timeout} 秒以内に応答がありませんでした。")
+        except Exception as e:
+            logging.error(f"[Search] Query embedding failed: {e}")
+            raise RuntimeError(f"Google Gemini Embedding Error: {str(e)}")
+        vectors = fit_dimension(result["embedding"])
+        await asyncio.to_thread(
+            _embedding_cache.put_many, EMBEDDING_MODEL, "retrieval_query", EMBEDDING_DIMENSION, chunk_texts, vectors
+        )
+        for i, vector in zip(chunk, vectors):
+            embeddings[i] = vector
+    return embeddings
+
+
+async def aget_query_embedding(text: str, timeout: float | None = None) -> list[float]:
+    return (await aget_query_embeddings([text], timeout=timeout))[0]
+
+
+def normalize_query(text: str) -> str:
+    """検索クエリの表記を揃える (NFKC 正規化し、前後の空白を除いて連続する空白を1つにする)。"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def make_doc_id(case_id: str, image_path: str) -> str:
+    """case_id と画像ファイル名から、再構築しても変わらないドキュメントIDを作る。"""
+    filename = image_path.replace("\\", "/").split("/")[-1]
+    return f"{case_id}:{filename}"
+
 
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def build_index(
+    requests_per_minute: int | None = None,
+    batch_size: int = EMBED_BATCH_SIZE,
+    workers: int = EMBED_WORKERS,
+    full: bool = False,
+) -> "chromadb.Collection":
+    """
+    enriched_data.json の内容でインデックスの新しい版を作り、検証してから現在の版に切り替える。
+    新規・説明文が変わったドキュメントだけを Embedding し、それ以外は現在の版のベクトルを引き継ぐ。
+    full=True の場合は引き継がずに全件を Embedding する。
+    構築中も現在の版はそのまま検索でき、失敗した場合は現在の版を残したまま例外を送出する。
+    """
     if not ENRICHED_DATA_PATH.exists():
         raise FileNotFoundError(
             f"{ENRICHED_DATA_PATH} が見つかりません。先に enricher.py を実行してください。"
@@ -157,235 +1151,1002 @@ def build_index() -> chromadb.Collection:
     with open(ENRICHED_DATA_PATH, "r", encoding="utf-8") as f:
         cases = json.load(f)
 
+    import chromadb
+
+    client = chromadb.PersistentClient(path=str(CHROMA_DIR))
+
+    active = read_active_index()
+    existing = [c.name for c in client.list_collections()]
+    current_name = active_collection_name(active)
+    current = client.get_collection(current_name) if current_name in existing else None
+    if not full and current is not None:
+        stored_dim = index_dimension(current)
+        if stored_dim is not None and stored_dim != embedding_dimension():
+            # 次元が変わると (モデル既定に戻す場合も) 現在の版のベクトルは引き継げない
+            print(f"[Search] Embedding の次元が {stored_dim} -> {embedding_dimension()} に変わるため、全件を再構築します。")
+            full = True
+
+    # 新しい版は別のコレクション・ディレクトリに作る (現在の版は切り替えるまで触らない)
+    version = time.strftime("%Y%m%d%H%M%S")
+    while f"{COLLECTION_NAME}_v{version}" in existing or (INDEXES_DIR / version).exists():
+        time.sleep(1)
+        version = time.strftime("%Y%m%d%H%M%S")
+    new_index = {"version": version, "collection": f"{COLLECTION_NAME}_v{version}"}
+    version_dir = INDEXES_DIR / version
+    version_dir.mkdir(parents=True)
     collection = client.create_collection(
-        name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"},
+        name=new_index["collection"],
+        metadata=collection_metadata(),
     )
+    print(f"[Search] 新しい版 {version} を構築します (現在の版: {current_name})")
 
-    doc_id = 0
-    import time
-    
     log_file = open("rebuild_progress.log", "w", encoding="utf-8")
     def log(msg):
         print(msg)
         log_file.write(msg + "\n")
         log_file.flush()
 
-    total_descriptions = sum(len(c.get("descriptions", [])) for c in cases)
-    log(f"[Search] Total descriptions to index: {total_descriptions}")
+    # ここから切り替えまでに失敗した場合は、作りかけの版 (コレクションとディレクトリ) を捨てて現在の版を残す。
+    # Embedding 済みの分はキャッシュに残るので、次回の構築では API を呼ばない。
+    try:
+        # 製品カタログ (表記ゆれをまとめた製品ID と製品グループ) を先に作り、各ドキュメントに製品IDを持たせる
+        product_catalog = ProductCatalog.build([
+            *load_unique_products(),
+            *(p for case in cases for p in case.get("products", [])),
+            *(p for case in cases for d in case.get("descriptions", []) for p in d.get("refined_products", [])),
+        ])
+        product_catalog.save(artifact_path(PRODUCT_CATALOG_PATH, new_index))
+        log(f"[Search] {PRODUCT_CATALOG_PATH.name} を更新しました: {len(product_catalog)} 製品")
 
-    for case in cases:
-        for desc_entry in case.get("descriptions", []):
-            description = desc_entry.get("description", "")
-            if not description:
-                continue
+        desired = {}  # doc_id -> (description, metadata)
+        lexical_docs = []  # (doc_id, {フィールド: テキスト})
+        doc_products = []  # (doc_id, case_id, 画像ごとの製品名)
+        for case in cases:
+            for desc_entry in case.get("descriptions", []):
+                description = desc_entry.get("description", "")
+                if not description:
+                    continue
 
-            # Use pre-calculated refined products from enriched_data.json
-            refined_products = desc_entry.get("refined_products", [])
-            
-            metadata = {
-                "case_id": case.get("case_id", ""),
-                "project_name": case.get("project_name", ""),
-                "products": "、".join(refined_products), 
-                "location": case.get("location", ""),
-                "image_path": desc_entry.get("image_path", ""),
-                "url": case.get("url", ""),
-            }
+                # Use pre-calculated refined products from enriched_data.json
+                refined_products = desc_entry.get("refined_products", [])
+                image_path = desc_entry.get("image_path", "")
 
-            try:
-                embedding = get_embedding(description)
-                time.sleep(0.5) # Rate limit handling
-            except Exception as e:
-                log(f"[Search] Embedding Error for {metadata['image_path']}: {e}")
-                continue
+                metadata = {
+                    "case_id": case.get("case_id", ""),
+                    "project_name": case.get("project_name", ""),
+                    "products": "、".join(refined_products),
+                    "location": case.get("location", ""),
+                    "image_path": image_path,
+                    "url": case.get("url", ""),
+                    "content_hash": content_hash(description),
+                }
+                metadata.update(facet_metadata(metadata, product_catalog))
+                doc_id = make_doc_id(metadata["case_id"], image_path)
+                if doc_id in desired:
+                    log(f"[Search] 重複した画像をスキップ: {doc_id}")
+                    continue
+                desired[doc_id] = (description, metadata)
+                lexical_docs.append((doc_id, {
+                    "project_name": metadata["project_name"],
+                    # 画像ごとの製品に加えて、事例全体の製品名でも引けるようにする
+                    "products": "、".join([*refined_products, *case.get("products", [])]),
+                    "location": metadata["location"],
+                    "description": description,
+                }))
+                doc_products.append((doc_id, metadata["case_id"], refined_products))
+
+        if current is not None and not full:
+            stored = current.get(include=["metadatas"])
+            stored_metas = dict(zip(stored["ids"], stored["metadatas"] or []))
+        else:
+            stored_metas = {}
+
+        to_embed = [
+            doc_id for doc_id, (_, meta) in desired.items()
+            if (stored_metas.get(doc_id) or {}).get("content_hash") != meta["content_hash"]
+        ]
+        to_embed_set = set(to_embed)
+        # 説明文が変わっていないドキュメントは、現在の版のベクトルを新しいメタデータで引き継ぐ
+        carried = [doc_id for doc_id in desired if doc_id not in to_embed_set]
+        to_delete = [doc_id for doc_id in stored_metas if doc_id not in desired]
+
+        log(
+            f"[Search] 差分: Embedding {len(to_embed)} 件, ベクトル引き継ぎ {len(carried)} 件, "
+            f"削除 {len(to_delete)} 件 (全 {len(desired)} 件)"
+        )
 
+        for i in range(0, len(carried), CHROMA_ADD_BATCH_SIZE):
+            chunk = carried[i:i + CHROMA_ADD_BATCH_SIZE]
+            got = current.get(ids=chunk, include=["embeddings"])
+            vectors = dict(zip(got["ids"], got["embeddings"]))
             collection.add(
-                ids=[str(doc_id)],
-                documents=[description],
-                embeddings=[embedding],
-                metadatas=[metadata],
+                ids=chunk,
+                documents=[desired[d][0] for d in chunk],
+                embeddings=[vectors[d] for d in chunk],
+                metadatas=[desired[d][1] for d in chunk],
             )
-            doc_id += 1
-            if doc_id % 10 == 0:
-                log(f"[Search] インデックス追加: {metadata['project_name']} ({doc_id}/{total_descriptions})")
 
-    log(f"[Search] インデックス構築完了: {doc_id} 件")
+        pending_ids, pending_docs, pending_embs, pending_metas = [], [], [], []
+        done = 0
+
+        def flush():
+            if not pending_ids:
+                return
+            collection.upsert(
+                ids=pending_ids[:],
+                documents=pending_docs[:],
+                embeddings=pending_embs[:],
+                metadatas=pending_metas[:],
+            )
+            for buf in (pending_ids, pending_docs, pending_embs, pending_metas):
+                buf.clear()
+
+        if to_embed:
+            limiter = TokenBucket(requests_per_minute or EMBED_REQUESTS_PER_MINUTE)
+            try:
+                for positions, embeddings in embed_concurrently(
+                    [desired[d][0] for d in to_embed],
+                    batch_size=batch_size,
+                    workers=workers,
+                    limiter=limiter,
+                ):
+                    batch = [to_embed[i] for i in positions]
+                    for doc_id, embedding in zip(batch, embeddings):
+                        description, metadata = desired[doc_id]
+                        pending_ids.append(doc_id)
+                        pending_docs.append(description)
+                        pending_embs.append(embedding)
+                        pending_metas.append(metadata)
+                    done += len(batch)
+
+                    if len(pending_ids) >= CHROMA_ADD_BATCH_SIZE:
+                        flush()
+                    log(f"[Search] インデックス追加: {desired[batch[-1]][1]['project_name']} ({done}/{len(to_embed)})")
+            except Exception as e:
+                log(f"[Search] Embedding Error: {e}")
+                raise RuntimeError(f"インデックス構築に失敗しました ({done}/{len(to_embed)} 件で停止): {e}") from e
+
+        flush()
+
+        data = collection.get(include=["documents", "metadatas", "embeddings"])
+        written = write_snapshot(data, artifact_path(SNAPSHOT_DIR, new_index))
+        log(f"[Search] スナップショットを書き出しました: {written} 件")
+
+        # 語彙インデックスは API を使わないので毎回全件から作り直す
+        LexicalIndex.build(lexical_docs).save(artifact_path(LEXICAL_INDEX_PATH, new_index))
+        log(f"[Search] {LEXICAL_INDEX_PATH.name} を更新しました: {len(lexical_docs)} 件")
+        products = ProductIndex.build(cases, doc_products, load_unique_products())
+        products.save(artifact_path(PRODUCT_INDEX_PATH, new_index))
+        log(f"[Search] {PRODUCT_INDEX_PATH.name} を更新しました: {len(products.postings)} 製品")
+
+        # 類似事例表は、ベクトルが変わった事例の分だけ現在の版の表から更新する
+        changed_cases = {desired[d][1]["case_id"] for d in to_embed}
+        changed_cases |= {(stored_metas[d] or {}).get("case_id", "") for d in to_delete}
+        previous = None if full else load_similar_cases(artifact_path(SIMILAR_CASES_PATH, active))
+        graph = build_similar_cases(
+            data["ids"], data["metadatas"], data["embeddings"],
+            previous=previous,
+            changed_cases=changed_cases if previous is not None else None,
+        )
+        save_similar_cases(graph, artifact_path(SIMILAR_CASES_PATH, new_index))
+        log(f"[Search] {SIMILAR_CASES_PATH.name} を更新しました: {len(graph['case_ids'])} 事例")
+        browse_table = build_browse_table(data["ids"], data["metadatas"])
+        save_browse_table(browse_table, artifact_path(BROWSE_TABLE_PATH, new_index))
+        log(f"[Search] {BROWSE_TABLE_PATH.name} を更新しました: {len(browse_table['case_ids'])} 事例")
+
+        new_index.update(validate_index(collection, new_index, expected_count=len(desired)))
+    except Exception as e:
+        log(f"[Search] 新しい版 {version} の構築に失敗しました: {e}")
+        log_file.close()
+        _discard_index_version(client, new_index)
+        raise
+
+    activate_index(new_index)
+    log(f"[Search] 現在の版を {version} に切り替えました (ロールバック先: {current_name})")
+    exported = export_index(data)
+    log(f"[Search] {EXPORT_PATH.name} を書き出しました: {exported} 件")
+    prune_index_versions(client)
+    log(f"[Search] インデックス構築完了: {collection.count()} 件")
     log_file.close()
 
-    print(f"[Search] インデックス構築完了: {doc_id} 件")
+    # 既存エンジンが保持している古い版を破棄
+    get_engine().reset()
     return collection
 
 
-def search(query: str, n_results: int = 300) -> list[dict]:
-    """自然言語で検索。類似度の高い事例を deduplicated（case_id単位）で返す。"""
-    configure_api()
+def validate_index(collection, index: dict, expected_count: int) -> dict:
+    """
+    切り替え前の版の検証。件数・次元・成果物の読み込みと、保存済みベクトルで自分自身が最近傍に返るかを確かめる。
+    問題があれば RuntimeError、なければ {"count", "dimension"} を返す。
+    """
+    count = collection.count()
+    if count != expected_count:
+        raise RuntimeError(f"件数が一致しません (コレクション {count} 件, 期待値 {expected_count} 件)")
+    dimension = index_dimension(collection)
+    if dimension is not None and dimension != embedding_dimension():
+        raise RuntimeError(f"Embedding の次元が一致しません ({dimension} != {embedding_dimension()})")
 
-    client = get_chroma_client()
-    existing = [c.name for c in client.list_collections()]
-    if COLLECTION_NAME not in existing:
-        raise RuntimeError("インデックスが未構築です。先にインデックスを構築してください。")
+    for path in (LEXICAL_INDEX_PATH, PRODUCT_INDEX_PATH, SIMILAR_CASES_PATH, BROWSE_TABLE_PATH):
+        if not artifact_path(path, index).exists():
+            raise RuntimeError(f"{path.name} がありません")
+    snapshot = load_snapshot(artifact_path(SNAPSHOT_DIR, index))
+    if snapshot is None or len(snapshot["ids"]) != count:
+        raise RuntimeError("スナップショットを読み込めないか、件数が一致しません")
 
-    collection = client.get_collection(COLLECTION_NAME)
-    query_embedding = get_query_embedding(query)
+    if count:
+        sample = collection.get(limit=INDEX_VALIDATION_QUERIES, include=["embeddings"])
+        if len(sample["embeddings"][0]) != embedding_dimension():
+            raise RuntimeError(
+                f"保存したベクトルの次元 ({len(sample['embeddings'][0])}) が設定 ({embedding_dimension()}) と一致しません"
+            )
+        hits = collection.query(query_embeddings=sample["embeddings"], n_results=1, include=["distances"])
+        for doc_id, distances in zip(sample["ids"], hits["distances"]):
+            # 同じ説明文のドキュメントがあると ID は入れ替わりうるので、距離がほぼ 0 かで判定する
+            if not distances or distances[0] > 1e-3:
+                raise RuntimeError(f"検索の確認に失敗しました: {doc_id} が最近傍に見つかりません")
+    return {"count": count, "dimension": dimension}
 
-    # Fetch more results to allow for deduplication
-    fetch_count = min(n_results * 5, collection.count())
-    
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=fetch_count,
-        include=["documents", "metadatas", "distances"],
-    )
 
-    search_results = []
-    
-    # Deduplication: Group by case_id, keep the best score
-    unique_cases = {}
-    
-    if results and results["ids"] and results["ids"][0]:
-        for i, doc_id in enumerate(results["ids"][0]):
-            meta = results["metadatas"][0][i]
-            case_id = meta.get("case_id", "")
-            distance = results["distances"][0][i] if results["distances"] else 0
-            
-            result_obj = {
-                "id": doc_id,
-                "case_id": case_id,
-                "project_name": meta.get("project_name", ""),
-                "products": meta.get("products", ""),
-                "location": meta.get("location", ""),
-                "image_path": meta.get("image_path", ""),
-                "url": meta.get("url", ""),
-                "description": results["documents"][0][i],
-                "distance": distance,
-            }
-            
-            if case_id not in unique_cases:
-                unique_cases[case_id] = result_obj
-            else:
-                # Update if new one is better (lower distance)
-                if distance < unique_cases[case_id]["distance"]:
-                    unique_cases[case_id] = result_obj
+def activate_index(index: dict) -> None:
+    """版のポインタを置き換えて現在の版にする。それまでの版は previous としてロールバック用に残す。"""
+    current = read_active_index()
+    _write_active_index({
+        **_index_entry(index),
+        "activated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "previous": _index_entry(current),
+    })
 
-    # Convert to list, sort by distance, and slice
-    search_results = list(unique_cases.values())
-    search_results.sort(key=lambda x: x["distance"])
-    
-    return search_results[:n_results]
+
+def rollback_index() -> dict:
+    """1つ前の版に戻す (現在の版は previous に入れ替わるので、もう一度呼ぶと戻せる)。"""
+    active = read_active_index()
+    if not active or not active.get("previous"):
+        raise RuntimeError("ロールバックできる版がありません。")
+    previous = active["previous"]
+    import chromadb
+
+    client = chromadb.PersistentClient(path=str(CHROMA_DIR))
+    if previous["collection"] not in [c.name for c in client.list_collections()]:
+        raise RuntimeError(f"1つ前の版のコレクション {previous['collection']} が見つかりません。")
+    activate_index(previous)
+    # 復元用の chroma_export.json も現在の版に合わせる
+    data = client.get_collection(previous["collection"]).get(include=["documents", "metadatas", "embeddings"])
+    export_index(data)
+    get_engine().reset()
+    return read_active_index()
+
+
+def _discard_index_version(client, index: dict) -> None:
+    try:
+        client.delete_collection(index["collection"])
+    except Exception as e:
+        logging.warning(f"[Search] 作りかけのコレクションを削除できませんでした: {e}")
+    shutil.rmtree(INDEXES_DIR / index["version"], ignore_errors=True)
+
+
+def prune_index_versions(client) -> None:
+    """現在の版と1つ前の版以外の、版付きコレクション・ディレクトリ (と使われなくなった旧コレクション) を消す。"""
+    active = read_active_index()
+    keep = [_index_entry(active), (active or {}).get("previous") or {}]
+    keep_collections = {k.get("collection") for k in keep}
+    keep_versions = {k.get("version") for k in keep}
+    pattern = re.compile(rf"{re.escape(COLLECTION_NAME)}(_v\d+)?")
+    for c in client.list_collections():
+        if pattern.fullmatch(c.name) and c.name not in keep_collections:
+            client.delete_collection(c.name)
+            print(f"[Search] 古い版のコレクションを削除しました: {c.name}")
+    if INDEXES_DIR.exists():
+        for path in INDEXES_DIR.iterdir():
+            if path.is_dir() and path.name not in keep_versions:
+                shutil.rmtree(path, ignore_errors=True)
 
 
-def get_similar_by_id(case_id: str, n_results: int = 6) -> list[dict]:
+def case_id_from_doc_id(doc_id: str) -> str | None:
+    """make_doc_id で作ったIDなら case_id を返す。旧形式の連番IDなら None。"""
+    case_id, sep, _ = doc_id.partition(":")
+    return case_id if sep else None
+
+
+def _aggregate_best(distances, groups, n_groups, first):
+    """事例内で最も近い画像の距離。"""
+    return distances[first]
+
+
+def _aggregate_mean_topk(distances, groups, n_groups, first, top_k: int = CASE_TOP_K):
+    """事例内で近い順に top_k 枚の画像の平均距離。"""
+    # 事例ごとに連続するよう並べ替え (stable なので事例内は距離の昇順のまま)
+    by_case = np.argsort(groups, kind="stable")
+    grouped = groups[by_case]
+    starts = np.searchsorted(grouped, np.arange(n_groups))
+    rank = np.arange(len(grouped)) - starts[grouped]
+    keep = rank < top_k
+    sums = np.bincount(grouped[keep], weights=distances[by_case][keep], minlength=n_groups)
+    counts = np.bincount(grouped[keep], minlength=n_groups)
+    return sums / counts
+
+
+# 事例単位の集約方法。(距離の昇順に並んだ距離, 事例番号, 事例数, 各事例の先頭位置) -> 事例ごとのスコア
+CASE_AGGREGATIONS = {
+    "best": _aggregate_best,
+    "mean_topk": _aggregate_mean_topk,
+}
+
+
+def group_by_case(
+    ids,
+    case_ids,
+    distances,
+    aggregate: str = "best",
+    exclude_case: str | None = None,
+) -> list[dict]:
     """
-    指定された case_id のベクトルを使って類似案件を検索する (More Like This)
+    ドキュメント単位のヒットを事例単位にまとめ、スコアの昇順で {"id", "case_id", "distance"} を返す。
+    距離でソートして np.unique で事例ごとの先頭 (=最も近い画像) を代表に選び、
+    スコアは CASE_AGGREGATIONS[aggregate] で計算する。辞書は残った事例の分だけ作る。
     """
-    client = get_chroma_client()
-    collection = client.get_collection(COLLECTION_NAME)
+    ids = np.asarray(ids)
+    cases = np.asarray(case_ids)
+    distances = np.asarray(distances, dtype=np.float64)
+    if exclude_case is not None:
+        keep = cases != exclude_case
+        ids, cases, distances = ids[keep], cases[keep], distances[keep]
+    if len(ids) == 0:
+        return []
 
-    # まず対象のドキュメント（Embedding）を取得
-    # メタデータで検索
-    target_docs = collection.get(
-        where={"case_id": case_id},
-        include=["embeddings"]
-    )
+    order = np.argsort(distances, kind="stable")
+    ids, cases, distances = ids[order], cases[order], distances[order]
+    unique_cases, first, groups = np.unique(cases, return_index=True, return_inverse=True)
+    scores = CASE_AGGREGATIONS[aggregate](distances, groups, len(unique_cases), first)
 
-    embeddings = target_docs.get("embeddings")
-    if embeddings is None or len(embeddings) == 0:
-        return []
+    # スコアが同じ場合は元の並び (距離順で先に現れた方) を優先する
+    ranked = np.lexsort((first, scores))
+    return [
+        {"id": str(ids[first[g]]), "case_id": str(unique_cases[g]), "distance": float(scores[g])}
+        for g in ranked
+    ]
 
-    # 最初のEmbeddingを使って検索 (1つの事例に複数の画像/説明がある場合は平均するか、最初の一つを使う)
-    # ここでは単純化のため最初のEmbeddingを使用
-    query_embedding = target_docs["embeddings"][0]
 
-    # Fetch more results to allow for deduplication
-    fetch_count = min((n_results + 1) * 5, collection.count())
+class SearchEngine:
+    """
+    ベクトルバックエンド (ChromaDB コレクション or NumpyIndex)・API設定をプロセス内で1度だけ初期化し、
+    全セッションで使い回す検索エンジン。app.py からは st.cache_resource 経由で保持する。
+    """
 
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=fetch_count,
-        include=["documents", "metadatas", "distances"],
-    )
-    
-    search_results = []
-    unique_cases = {}
-    
-    if results and results["ids"] and results["ids"][0]:
-        for i, doc_id in enumerate(results["ids"][0]):
-            meta = results["metadatas"][0][i]
-            res_case_id = meta.get("case_id", "")
-            distance = results["distances"][0][i]
-            
-            # 自分自身は除外
-            if res_case_id == case_id:
+    def __init__(self, backend: str | None = None, aggregate: str | None = None):
+        self.backend = backend or VECTOR_BACKEND
+        self.aggregate = aggregate or CASE_AGGREGATION
+        self._lock = threading.Lock()
+        self._active = None  # このエンジンが使っている版 (コレクションと成果物は同じ版から読む)
+        self._collection = None
+        self._reader = None
+        self._similar_cases = None
+        self._lexical = None
+        self._products = None
+        self._browse_table = None
+        self._allowed_cache = {}
+        self._dimension = None
+        self._inflight = SingleFlight()
+        self._ainflight = AsyncSingleFlight()
+        self._rankings = OrderedDict()  # カーソル -> 順位付きのヒット (LRU)
+        self._rankings_lock = threading.Lock()
+        self._cursor_specs = OrderedDict()  # カーソル -> 順位付きリストを計算する関数 (LRU)
+        self._api_configured = False
+
+    def _active_index(self) -> dict | None:
+        if self._active is None:
+            with self._lock:
+                if self._active is None:
+                    self._active = read_active_index() or False
+        return self._active or None
+
+    def _artifact(self, path: Path) -> Path:
+        return artifact_path(path, self._active_index())
+
+    def _get_collection(self):
+        if self._collection is not None:
+            return self._collection
+        active = self._active_index()
+        with self._lock:
+            if self._collection is None:
+                self._collection = open_vector_backend(self.backend, active)
+        return self._collection
+
+    def _ensure_api(self) -> None:
+        if self._api_configured:
+            return
+        with self._lock:
+            if not self._api_configured:
+                configure_api()
+                self._api_configured = True
+
+    def reset(self) -> None:
+        """インデックス再構築後などに、保持しているクライアントを破棄する。"""
+        with self._lock:
+            self._active = None
+            self._collection = None
+            self._reader = None
+            self._similar_cases = None
+            self._lexical = None
+            self._products = None
+            self._browse_table = None
+            self._allowed_cache = {}
+            self._dimension = None
+        with self._rankings_lock:
+            self._rankings.clear()
+
+    def count(self) -> int:
+        return self._get_collection().count()
+
+    def _check_dimension(self, query_embedding) -> None:
+        """クエリの Embedding がインデックスと同じ次元か確かめる (設定の食い違いを黙って検索しない)。"""
+        if self._dimension is None:
+            self._dimension = index_dimension(self._get_collection()) or 0
+        if self._dimension and len(query_embedding) != self._dimension:
+            raise RuntimeError(
+                f"クエリの Embedding の次元 ({len(query_embedding)}) がインデックスの次元 ({self._dimension}) と"
+                "一致しません。EMBEDDING_DIMENSION の設定を確認するか、インデックスを再構築してください。"
+            )
+
+    def _get_documents(self):
+        """
+        説明文・メタデータの取得先。コレクションを開いていればそれを、まだなら (一覧表示だけの間は)
+        スナップショットの軽量な読み手を使い、chromadb を読み込まずに済ませる。
+        """
+        if self._collection is not None:
+            return self._collection
+        if self._reader is None:
+            path = self._artifact(SNAPSHOT_DIR)
+            with self._lock:
+                if self._reader is None:
+                    self._reader = SnapshotReader.open(path) or False
+        return self._reader or self._get_collection()
+
+    def _get_similar_cases(self) -> SimilarCasesTable | None:
+        if self._similar_cases is None:
+            path = self._artifact(SIMILAR_CASES_PATH)
+            with self._lock:
+                if self._similar_cases is None:
+                    graph = load_similar_cases(path)
+                    # 読み込めなかった場合も毎回ファイルを見に行かないよう False を入れておく
+                    self._similar_cases = SimilarCasesTable(graph) if graph is not None else False
+        return self._similar_cases or None
+
+    def _get_lexical(self) -> LexicalIndex | None:
+        if self._lexical is None:
+            path = self._artifact(LEXICAL_INDEX_PATH)
+            with self._lock:
+                if self._lexical is None:
+                    # 読み込めなかった場合も毎回ファイルを見に行かないよう False を入れておく
+                    self._lexical = LexicalIndex.load(path) or False
+        return self._lexical or None
+
+    def _get_products(self) -> ProductIndex | None:
+        if self._products is None:
+            path = self._artifact(PRODUCT_INDEX_PATH)
+            with self._lock:
+                if self._products is None:
+                    self._products = ProductIndex.load(path) or False
+        return self._products or None
+
+    def _get_browse_table(self) -> BrowseTable | None:
+        if self._browse_table is None:
+            path = self._artifact(BROWSE_TABLE_PATH)
+            with self._lock:
+                if self._browse_table is None:
+                    table = load_browse_table(path)
+                    self._browse_table = BrowseTable(table) if table is not None else False
+        return self._browse_table or None
+
+    def _allowed_ids(self, where: dict | None) -> set[str] | None:
+        """絞り込み条件に一致するドキュメントIDの集合。条件ごとにキャッシュする。"""
+        if not where:
+            return None
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        if key not in self._allowed_cache:
+            matched = self._get_collection().get(where=where, include=[])
+            self._allowed_cache[key] = set(matched["ids"])
+        return self._allowed_cache[key]
+
+    def _lexical_allowed(self, lexical: LexicalIndex, where: dict | None):
+        """絞り込み条件に一致する語彙インデックスの行 (bool 配列)。"""
+        allowed = self._allowed_ids(where)
+        if allowed is None:
+            return None
+        return lexical.positions(allowed)
+
+    def _case_ids_for(self, ids: list[str]) -> list[str]:
+        """
+        ドキュメントIDから case_id を求める。"<case_id>:<画像名>" 形式ならIDから読み取り、
+        旧形式 (連番) のIDのときだけメタデータを引く。
+        """
+        case_ids = [case_id_from_doc_id(doc_id) for doc_id in ids]
+        legacy = [doc_id for doc_id, case_id in zip(ids, case_ids) if case_id is None]
+        if legacy:
+            got = self._get_collection().get(ids=legacy, include=["metadatas"])
+            by_id = {d: (m or {}).get("case_id", "") for d, m in zip(got["ids"], got["metadatas"])}
+            case_ids = [c if c is not None else by_id.get(d, "") for d, c in zip(ids, case_ids)]
+        return case_ids
+
+    def hydrate(self, hits: list[dict]) -> list[dict]:
+        """
+        search_ids / similar_ids / browse_ids が返した軽量なヒットに、説明文とメタデータを付けて
+        画面表示用の結果にする。表示するページ分だけ呼ぶことを想定している。
+        """
+        if not hits:
+            return []
+        got = self._get_documents().get(
+            ids=[hit["id"] for hit in hits],
+            include=["documents", "metadatas"],
+        )
+        by_id = {
+            doc_id: (document, meta or {})
+            for doc_id, document, meta in zip(got["ids"], got["documents"], got["metadatas"])
+        }
+        results = []
+        for hit in hits:
+            if hit["id"] not in by_id:
                 continue
-                
-            result_obj = {
-                "id": doc_id,
-                "case_id": res_case_id,
+            document, meta = by_id[hit["id"]]
+            results.append({
+                "id": hit["id"],
+                "case_id": meta.get("case_id", hit["case_id"]),
                 "project_name": meta.get("project_name", ""),
                 "products": meta.get("products", ""),
                 "location": meta.get("location", ""),
                 "image_path": meta.get("image_path", ""),
                 "url": meta.get("url", ""),
-                "description": results["documents"][0][i],
-                "distance": distance,
-            }
-            
-            if res_case_id not in unique_cases:
-                unique_cases[res_case_id] = result_obj
+                "description": document,
+                "distance": hit["distance"],
+            })
+        return results
+
+    def search_ids(self, query: str, n_results: int = 300, filters: dict | None = None) -> list[dict]:
+        """
+        検索の1段目。ID・距離・case_id だけを取得して事例単位に重複排除し、
+        {"id", "case_id", "distance"} のリストを関連度の高い順に返す。説明文は hydrate() で付ける。
+
+        - クエリが製品カタログの製品名に一致・近似するなら、製品のポスティングリストから Embedding なしで返す。
+        語彙インデックスがある場合:
+        - クエリが製品名・地名そのもの (フレーズ一致) なら、Embedding API を呼ばずに語彙検索だけで返す。
+        - それ以外はベクトル検索と語彙検索の順位を RRF で統合する。
+        distance はベクトル検索のコサイン距離で、ベクトル検索を経ていないヒットでは 0.0。
+
+        クエリは NFKC 正規化・空白の整理をしてから検索し、同じクエリ・条件の検索が実行中なら
+        その結果を待って共有する (同時に来た同じクエリで Embedding API を何度も呼ばない)。
+        """
+        query = normalize_query(query)
+        key = (query, n_results, json.dumps(filters, sort_keys=True, ensure_ascii=False))
+        hits, shared = self._inflight.do(
+            key, lambda: self.search_many_ids([query], n_results=n_results, filters=filters)[0]
+        )
+        # 合流した呼び出し元どうしでリストを共有しないよう複製して渡す
+        return [dict(hit) for hit in hits] if shared else hits
+
+    def search_many_ids(self, queries: list[str], n_results: int = 300, filters: dict | None = None) -> list[list[dict]]:
+        """
+        複数クエリの search_ids。Embedding が必要なクエリはまとめて1回のバッチリクエストで Embedding し、
+        ベクトル検索も1回の複数クエリ問い合わせで行う。戻り値は queries と同じ順序のヒットのリスト。
+        """
+        collection = self._get_collection()
+        where = build_where(filters)
+        # Fetch more results to allow for deduplication
+        fetch_count = min(n_results * 5, collection.count())
+
+        results = [self._search_without_embedding(q, n_results, where, fetch_count) for q in queries]
+        pending = [i for i, hits in enumerate(results) if hits is None]
+        if not pending:
+            return results
+
+        self._ensure_api()
+        embeddings = get_query_embeddings([queries[i] for i in pending])
+        self._vector_search(queries, pending, embeddings, results, n_results, where, fetch_count)
+        return results
+
+    async def asearch_ids(self, query: str, n_results: int = 300, filters: dict | None = None,
+                          timeout: float | None = None) -> list[dict]:
+        """search_ids の asyncio 版。クエリの正規化と、実行中の同じ検索への合流は search_ids と同じ。"""
+        query = normalize_query(query)
+        key = (query, n_results, json.dumps(filters, sort_keys=True, ensure_ascii=False))
+        hits, shared = await self._ainflight.do(
+            key, lambda: self._asearch_one(query, n_results, filters, timeout)
+        )
+        return [dict(hit) for hit in hits] if shared else hits
+
+    async def _asearch_one(self, query: str, n_results: int, filters: dict | None, timeout: float | None) -> list[dict]:
+        return (await self.asearch_many_ids([query], n_results=n_results, filters=filters, timeout=timeout))[0]
+
+    async def asearch_many_ids(self, queries: list[str], n_results: int = 300, filters: dict | None = None,
+                               timeout: float | None = None) -> list[list[dict]]:
+        """
+        search_many_ids の asyncio 版。Embedding API の待ち時間はイベントループ上で待つので、
+        同時に多数のクエリを処理してもユーザーごとにスレッドを占有しない。
+        timeout 秒 (省略時は QUERY_EMBED_TIMEOUT) で Embedding が返らなければ RuntimeError。
+        タスクがキャンセルされた場合は、実行中の API 呼び出しも取り消される。
+        ローカルの処理 (コレクションを開く・検索する・API を設定する) はブロックするので、
+        既定のスレッドプールで実行する。
+        """
+        where = build_where(filters)
+
+        def search_local():
+            fetch_count = min(n_results * 5, self._get_collection().count())
+            return fetch_count, [self._search_without_embedding(q, n_results, where, fetch_count) for q in queries]
+
+        fetch_count, results = await asyncio.to_thread(search_local)
+        pending = [i for i, hits in enumerate(results) if hits is None]
+        if not pending:
+            return results
+
+        await asyncio.to_thread(self._ensure_api)
+        embeddings = await aget_query_embeddings([queries[i] for i in pending], timeout=timeout)
+        await asyncio.to_thread(
+            self._vector_search, queries, pending, embeddings, results, n_results, where, fetch_count
+        )
+        return results
+
+    def _vector_search(self, queries, pending, embeddings, results, n_results, where, fetch_count) -> None:
+        """pending のクエリを1回の複数クエリ問い合わせでベクトル検索し、results の該当位置を埋める。"""
+        self._check_dimension(embeddings[0])
+        found = self._get_collection().query(
+            query_embeddings=embeddings,
+            n_results=fetch_count,
+            where=where,
+            include=["distances"],
+        )
+        for j, i in enumerate(pending):
+            ids = found["ids"][j] if found and found["ids"] else []
+            distances = found["distances"][j] if ids else []
+            results[i] = self._rank_vector_hits(queries[i], ids, distances, n_results, where, fetch_count)
+
+    def _search_without_embedding(self, query: str, n_results: int, where: dict | None, fetch_count: int):
+        """
+        製品名そのもの・フレーズ一致で Embedding なしに答えられればそのヒット、答えられなければ None。
+        製品名の一部・近似一致は、ここでは答えずにベクトル検索側で順位を押し上げる (_rank_vector_hits)。
+        """
+        products = self._get_products()
+        if products is not None:
+            matched = products.lookup(query, allowed=self._allowed_ids(where), whole_name=True)
+            if matched:
+                return [
+                    {"id": doc_id, "case_id": case_id, "distance": 0.0}
+                    for case_id, doc_id, _ in matched[:n_results]
+                ]
+
+        lexical = self._get_lexical()
+        if lexical is not None:
+            allowed = self._lexical_allowed(lexical, where)
+            phrase = lexical.phrase_matches(query)
+            if allowed is not None:
+                phrase &= allowed
+            if phrase.any():
+                lex_hits = lexical.search(query, fetch_count, allowed=phrase)
+                lex_ids = [doc_id for doc_id, _ in lex_hits]
+                hits = group_by_case(
+                    lex_ids, self._case_ids_for(lex_ids), [-score for _, score in lex_hits],
+                    aggregate=self.aggregate,
+                )
+                for hit in hits:
+                    hit["distance"] = 0.0
+                return hits[:n_results]
+        return None
+
+    def _rank_vector_hits(self, query: str, ids: list[str], distances: list[float], n_results: int,
+                          where: dict | None, fetch_count: int) -> list[dict]:
+        """
+        ベクトル検索の結果を、語彙検索と製品名の部分一致・近似一致 (あれば) と RRF で統合して事例単位にまとめる。
+        """
+        rankings = [ids]
+        lexical = self._get_lexical()
+        if lexical is not None:
+            allowed = self._lexical_allowed(lexical, where)
+            rankings.append([doc_id for doc_id, _ in lexical.search(query, fetch_count, allowed=allowed)])
+        products = self._get_products()
+        if products is not None:
+            matched = products.lookup(query, allowed=self._allowed_ids(where))
+            if matched:
+                rankings.append([doc_id for _, doc_id, _ in matched[:fetch_count]])
+        if len(rankings) == 1:
+            if not ids:
+                return []
+            hits = group_by_case(ids, self._case_ids_for(ids), distances, aggregate=self.aggregate)
+            return hits[:n_results]
+
+        # ベクトル検索・語彙検索・製品名一致の順位を RRF で統合する
+        fused = rrf_fuse(rankings, k=RRF_K)
+        if not fused:
+            return []
+        fused_ids = list(fused)
+        hits = group_by_case(
+            fused_ids, self._case_ids_for(fused_ids), [-fused[d] for d in fused_ids],
+            aggregate=self.aggregate,
+        )
+        vector_distance = dict(zip(ids, distances))
+        for hit in hits:
+            hit["distance"] = float(vector_distance.get(hit["id"], 0.0))
+        return hits[:n_results]
+
+    def search(self, query: str, n_results: int = 300, filters: dict | None = None) -> list[dict]:
+        """
+        自然言語で検索。類似度の高い事例を deduplicated（case_id単位）で返す。
+        filters (catalog.build_where 参照) を渡すと、エンジン側で絞り込んだ上で上位を返す。
+        """
+        return self.hydrate(self.search_ids(query, n_results=n_results, filters=filters))
+
+    def search_many(self, queries: list[str], n_results: int = 300, filters: dict | None = None) -> list[list[dict]]:
+        """複数クエリの search。オフライン評価やクエリログからのウォームアップ用。"""
+        return [
+            self.hydrate(hits)
+            for hits in self.search_many_ids(queries, n_results=n_results, filters=filters)
+        ]
+
+    async def asearch(self, query: str, n_results: int = 300, filters: dict | None = None,
+                      timeout: float | None = None) -> list[dict]:
+        """search の asyncio 版。"""
+        hits = await self.asearch_ids(query, n_results=n_results, filters=filters, timeout=timeout)
+        return await asyncio.to_thread(self.hydrate, hits)
+
+    def similar_ids(self, case_id: str, n_results: int = 6, filters: dict | None = None) -> list[dict]:
+        """
+        類似事例検索の1段目。構築時に計算した類似事例表にあればそこから引き、
+        なければベクトル検索で求める。戻り値の形は search_ids と同じ。
+        """
+        where = build_where(filters)
+
+        # 類似事例表から引けるときはコレクションを開かない (絞り込みがなければ chromadb も読み込まない)
+        table = self._get_similar_cases()
+        if table is not None and case_id in table and (n_results <= table.k or table.complete):
+            if where:
+                # 条件に一致する画像を1枚でも持つ事例だけを残す
+                allowed = set(self._case_ids_for(list(self._allowed_ids(where))))
+                neighbors = [n for n in table.lookup(case_id, table.k) if n[0] in allowed][:n_results]
             else:
-                 # Update if new one is better (lower distance)
-                if distance < unique_cases[res_case_id]["distance"]:
-                    unique_cases[res_case_id] = result_obj
+                neighbors = table.lookup(case_id, n_results)
+            return [
+                {"id": doc_id, "case_id": res_case_id, "distance": distance}
+                for res_case_id, doc_id, distance in neighbors
+            ]
 
-    # Convert to list, sort by distance, and slice
-    search_results = list(unique_cases.values())
-    search_results.sort(key=lambda x: x["distance"])
-    
-    return search_results[:n_results]
+        collection = self._get_collection()
+        # まず対象のドキュメント（Embedding）を取得
+        # メタデータで検索
+        target_docs = collection.get(
+            where={"case_id": case_id},
+            include=["embeddings"]
+        )
+
+        embeddings = target_docs.get("embeddings")
+        if embeddings is None or len(embeddings) == 0:
+            return []
+
+        # 最初のEmbeddingを使って検索 (1つの事例に複数の画像/説明がある場合は平均するか、最初の一つを使う)
+        # ここでは単純化のため最初のEmbeddingを使用
+        query_embedding = target_docs["embeddings"][0]
+
+        # Fetch more results to allow for deduplication
+        fetch_count = min((n_results + 1) * 5, collection.count())
+
+        results = collection.query(
+            query_embeddings=[query_embedding],
+            n_results=fetch_count,
+            where=where,
+            include=["distances"],
+        )
+        if not results or not results["ids"] or not results["ids"][0]:
+            return []
+        ids = results["ids"][0]
+        # 自分自身は除外
+        hits = group_by_case(
+            ids, self._case_ids_for(ids), results["distances"][0],
+            aggregate=self.aggregate, exclude_case=case_id,
+        )
+        return hits[:n_results]
+
+    def similar(self, case_id: str, n_results: int = 6, filters: dict | None = None) -> list[dict]:
+        """
+        指定された case_id のベクトルを使って類似案件を検索する (More Like This)
+        """
+        return self.hydrate(self.similar_ids(case_id, n_results=n_results, filters=filters))
 
+    def browse_ids(self, n_results: int | None = None, filters: dict | None = None, sort: str = "case_id"):
+        """
+        一覧表示の1段目。{"id", "case_id", "distance"} を事例単位で返す (n_results=None で全事例)。
+        ブラウズ表があれば、それを絞り込んだ安定した順序 (既定は case_id の降順) の遅延評価のヒット列を返す。
+        """
+        table = self._get_browse_table()
+        if table is not None:
+            hits = table.hits(filters, sort=sort)
+            return hits if n_results is None else hits[:n_results]
 
-def get_all_items(n_results: int = 300) -> list[dict]:
+        # ブラウズ表が無い (古いインデックス) 場合は、ドキュメントを取得して事例単位にまとめる
+        collection = self._get_collection()
+
+        # peekだとランダムではないが、全件取得には使える
+        # limitより多い場合はgetを使う
+        count = collection.count()
+        limit = count if n_results is None else min(n_results, count)
+
+        results = collection.get(
+            where=build_where(filters),
+            limit=limit,
+            include=[],
+        )
+        ids = results["ids"] if results else []
+        # distance lookup not applicable
+        # No distance sorting needed for 'all' view, just distinct case_ids
+        return group_by_case(ids, self._case_ids_for(ids), np.zeros(len(ids)))
+
+    def browse(self, n_results: int = 300, filters: dict | None = None) -> list[dict]:
+        """
+        インデックスされている全ての（または指定数の）データを取得する。
+        デフォルトの表示や「全件表示」に使用。APIキー不要（ChromaDB読み込みのみ）。
+        """
+        return self.hydrate(self.browse_ids(n_results=n_results, filters=filters))
+
+    def _open_cursor(self, spec: list, compute, window: int | None = None) -> dict:
+        """
+        spec (検索の種類と条件) に対応する順位付きリストを LRU に置き、{"cursor", "total", "more"} を返す。
+        同じ条件のリストが残っていれば計算し直さない。
+        window を渡すと compute(件数) で上位 window 件だけを求め (more はその先がありうるか)、
+        search_page がその先のページを求めたときに広げる。window がなければ compute() が全件を返す。
+        """
+        cursor = hashlib.sha1(json.dumps(spec, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+        with self._rankings_lock:
+            self._cursor_specs[cursor] = (compute, window)
+            self._cursor_specs.move_to_end(cursor)
+            while len(self._cursor_specs) > CURSOR_SPEC_CACHE_SIZE:
+                self._cursor_specs.popitem(last=False)
+        hits, more = self._ranking(cursor)
+        return {"cursor": cursor, "total": len(hits), "more": more}
+
+    def _ranking(self, cursor: str, needed: int = 0) -> tuple[list[dict], bool]:
+        """
+        カーソルの順位付きリストと、窓で打ち切っていてその先がありうるか。
+        needed 件目より先まで要るのに窓で打ち切っていれば、窓を広げて求め直す。
+        reset() や LRU で捨てられていれば、覚えている条件から計算し直す
+        (インデックスが切り替わっていれば新しい版で求め直す)。条件も残っていなければ RuntimeError。
+        """
+        with self._rankings_lock:
+            entry = self._rankings.get(cursor)
+            if entry is not None:
+                self._rankings.move_to_end(cursor)
+            spec = self._cursor_specs.get(cursor)
+        served = []
+        if entry is not None:
+            hits, limit = entry  # limit: 打ち切った件数 (全件そろっていれば None)
+            if limit is None or needed < len(hits) or spec is None:
+                return hits, limit is not None
+            served = hits
+            limit = max(limit * 2, needed + 1)
+        elif spec is None:
+            raise RuntimeError("検索結果の有効期限が切れました。もう一度検索してください。")
+        else:
+            limit = spec[1]
+            if limit is not None:
+                limit = max(limit, needed + 1)
+
+        compute, window = spec
+        hits = compute() if window is None else compute(limit)
+        if limit is not None and len(hits) < limit:
+            limit = None  # 窓より少なければ全件そろっている
+        if served:
+            # 広げると順位が入れ替わることがあるので、表示済みの範囲はそのまま残し、その後ろに未出の事例だけを足す
+            # (ページを送っても同じ事例が2度出たり、抜けたりしない)
+            seen = {hit["case_id"] for hit in served}
+            hits = served + [hit for hit in hits if hit["case_id"] not in seen]
+        with self._rankings_lock:
+            self._rankings[cursor] = (hits, limit)
+            self._rankings.move_to_end(cursor)
+            while len(self._rankings) > RANKING_CACHE_SIZE:
+                self._rankings.popitem(last=False)
+        return hits, limit is not None
+
+    def search_cursor(self, query: str, filters: dict | None = None) -> dict:
+        """
+        クエリの事例の順位を求めてカーソルを返す。結果は search_page でページ単位に取り出す。
+        最初は上位 SEARCH_CURSOR_WINDOW 事例だけを求め、その先のページが要求されたら広げて求め直すので、
+        1ページ目のコストはコーパスの大きさによらず、深いページの事例にも到達できる。
+        """
+        query = normalize_query(query)
+        return self._open_cursor(
+            ["search", query, filters],
+            lambda n: self.search_ids(query, n_results=n, filters=filters),
+            window=SEARCH_CURSOR_WINDOW,
+        )
+
+    def similar_cursor(self, case_id: str, n_results: int = 100, filters: dict | None = None) -> dict:
+        """類似事例の順位付きリストのカーソル。"""
+        return self._open_cursor(
+            ["similar", case_id, n_results, filters],
+            lambda: self.similar_ids(case_id, n_results=n_results, filters=filters),
+        )
+
+    def browse_cursor(self, n_results: int | None = None, filters: dict | None = None,
+                      sort: str = "case_id") -> dict:
+        """一覧表示のカーソル。既定では絞り込み後の全事例をページ送りできる。"""
+        return self._open_cursor(
+            ["browse", n_results, filters, sort],
+            lambda: self.browse_ids(n_results=n_results, filters=filters, sort=sort),
+        )
+
+    def search_page(self, cursor: str, page: int = 0, page_size: int = 24) -> dict:
+        """
+        カーソルの順位付きリストから1ページ分だけ説明文・メタデータを付けて返す。
+        戻り値は {"results", "total", "page", "pages", "start", "more"}。page は範囲内に丸める。
+        リストが捨てられていれば作り直すので、reset() の後や古いカーソルでもページを返せる。
+        検索のカーソルでは total は求めた範囲の件数で、more が True ならその先にも事例がありうる
+        (ページが求めた範囲の末尾に届いたら範囲を広げるので、次のページは常に存在する)。
+        """
+        hits, more = self._ranking(cursor, needed=(max(page, 0) + 1) * page_size)
+        total = len(hits)
+        pages = max(1, (total + page_size - 1) // page_size)
+        page = max(0, min(page, pages - 1))
+        start = page * page_size
+        return {
+            "results": self.hydrate(hits[start:start + page_size]),
+            "total": total,
+            "page": page,
+            "pages": pages,
+            "start": start,
+            "more": more,
+        }
+
+
+_default_engine: SearchEngine | None = None
+_default_engine_lock = threading.Lock()
+
+
+def get_engine() -> SearchEngine:
+    """モジュール関数 (search / get_similar_by_id / get_all_items) が共有するエンジン。"""
+    global _default_engine
+    if _default_engine is None:
+        with _default_engine_lock:
+            if _default_engine is None:
+                _default_engine = SearchEngine()
+    return _default_engine
+
+
+def search(query: str, n_results: int = 300, filters: dict | None = None) -> list[dict]:
+    """自然言語で検索。類似度の高い事例を deduplicated（case_id単位）で返す。"""
+    return get_engine().search(query, n_results=n_results, filters=filters)
+
+
+def search_many(queries: list[str], n_results: int = 300, filters: dict | None = None) -> list[list[dict]]:
+    """複数クエリをまとめて検索する (Embedding は1回のバッチリクエスト)。"""
+    return get_engine().search_many(queries, n_results=n_results, filters=filters)
+
+
+async def asearch(query: str, n_results: int = 300, filters: dict | None = None,
+                  timeout: float | None = None) -> list[dict]:
+    """search の asyncio 版。"""
+    return await get_engine().asearch(query, n_results=n_results, filters=filters, timeout=timeout)
+
+
+def search_cursor(query: str, filters: dict | None = None) -> dict:
+    """クエリの事例の順位を求めてカーソルを返す。ページは search_page で取り出す。"""
+    return get_engine().search_cursor(query, filters=filters)
+
+
+def search_page(cursor: str, page: int = 0, page_size: int = 24) -> dict:
+    """search_cursor で得たカーソルの1ページ分を返す。"""
+    return get_engine().search_page(cursor, page=page, page_size=page_size)
+
+
+def get_similar_by_id(case_id: str, n_results: int = 6, filters: dict | None = None) -> list[dict]:
+    """
+    指定された case_id のベクトルを使って類似案件を検索する (More Like This)
+    """
+    return get_engine().similar(case_id, n_results=n_results, filters=filters)
+
+
+def get_all_items(n_results: int = 300, filters: dict | None = None) -> list[dict]:
     """
     インデックスされている全ての（または指定数の）データを取得する。
     デフォルトの表示や「全件表示」に使用。APIキー不要（ChromaDB読み込みのみ）。
     """
-    client = get_chroma_client()
-    collection = client.get_collection(COLLECTION_NAME)
-    
-    # peekだとランダムではないが、全件取得には使える
-    # limitより多い場合はgetを使う
-    count = collection.count()
-    limit = min(n_results, count)
-    
-    results = collection.get(
-        limit=limit,
-        include=["documents", "metadatas"]
-    )
-    
-    unique_cases = {}
-
-    if results and results["ids"]:
-        for i, doc_id in enumerate(results["ids"]):
-            meta = results["metadatas"][i]
-            case_id = meta.get("case_id", "")
-            
-            result_obj = {
-                "id": doc_id,
-                "case_id": case_id,
-                "project_name": meta.get("project_name", ""),
-                "products": meta.get("products", ""),
-                "location": meta.get("location", ""),
-                "image_path": meta.get("image_path", ""),
-                "url": meta.get("url", ""),
-                "description": results["documents"][i],
-                "distance": 0.0, # distance lookup not applicable
-            }
-            
-            if case_id not in unique_cases:
-                unique_cases[case_id] = result_obj
-            # No distance sorting needed for 'all' view, just distinct case_ids
-            
-    return list(unique_cases.values())
+    return get_engine().browse(n_results=n_results, filters=filters)
+
+
+# モジュールの読み込みにかかった秒数 (コールドスタートの計測用。app.py が起動時にログに出す)
+IMPORT_SECONDS = time.perf_counter() - _import_started
 
 if __name__ == "__main__":
     build_index()
@@ -0,0 +1,196 @@
+"""
+「この事例に似た案件を探す」用の、事例単位の近傍グラフ。
+
+インデックス構築時に事例ごとの上位 K 件の類似事例を計算し、npz ファイルに保存する。
+事例間の距離は、両事例の画像ベクトル同士で最も近いペアのコサイン距離 (=検索結果の重複排除と同じ「ベスト画像」基準)。
+検索時はファイルを読み込んだ配列から定数時間で引くだけになる。
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+SIMILAR_CASES_K = 100
+
+
+def _normalize(vectors) -> np.ndarray:
+    v = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(v, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return v / norms
+
+
+def _group_docs(doc_ids: list[str], metadatas: list[dict], embeddings):
+    """ドキュメントを case_id 順に並べ替え、事例ごとの区間を返す。"""
+    case_of_doc = np.array([m.get("case_id", "") for m in metadatas])
+    order = np.argsort(case_of_doc, kind="stable")
+    case_of_doc = case_of_doc[order]
+    vectors = _normalize(embeddings)[order]
+    sorted_doc_ids = np.array(doc_ids)[order]
+    case_ids, starts, counts = np.unique(case_of_doc, return_index=True, return_counts=True)
+    return case_ids, starts, counts, vectors, sorted_doc_ids
+
+
+def _case_row(a: int, starts, counts, vectors, k: int, columns=None):
+    """
+    事例 a から見た各事例 (columns、省略時は全事例) への最良類似度と、そのときの相手側ドキュメント位置。
+    戻り値は (事例番号, 距離, ドキュメント位置) を距離昇順に最大 k 件。
+    """
+    sims = vectors[starts[a]:starts[a] + counts[a]] @ vectors.T
+    col_best = sims.max(axis=0)
+    if columns is None:
+        columns = np.arange(len(starts))
+    columns = columns[columns != a]
+    if len(columns) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, np.empty(0, dtype=np.float32), empty
+
+    best_sim = np.empty(len(columns), dtype=np.float32)
+    best_doc = np.empty(len(columns), dtype=np.int64)
+    for j, b in enumerate(columns):
+        seg = col_best[starts[b]:starts[b] + counts[b]]
+        pos = int(seg.argmax())
+        best_sim[j] = seg[pos]
+        best_doc[j] = starts[b] + pos
+
+    top = np.argsort(-best_sim, kind="stable")[:k]
+    return columns[top], 1.0 - best_sim[top], best_doc[top]
+
+
+def build_similar_cases(
+    doc_ids: list[str],
+    metadatas: list[dict],
+    embeddings,
+    k: int = SIMILAR_CASES_K,
+    previous: dict | None = None,
+    changed_cases: set[str] | None = None,
+) -> dict:
+    """
+    事例ごとの上位 k 件の類似事例表を作る。
+    previous と changed_cases (ベクトルが追加・変更・削除された事例) を渡すと、
+    変更事例の行だけを全件計算し直し、それ以外の行は変更事例との距離だけを計算してマージする。
+    """
+    case_ids, starts, counts, vectors, sorted_doc_ids = _group_docs(doc_ids, metadatas, embeddings)
+    n_cases = len(case_ids)
+    k = min(k, max(0, n_cases - 1))
+
+    neighbors = np.full((n_cases, k), -1, dtype=np.int32)
+    distances = np.full((n_cases, k), np.inf, dtype=np.float32)
+    neighbor_docs = np.full((n_cases, k), -1, dtype=np.int32)
+
+    def fill(a, cols, dists, docs):
+        neighbors[a, :len(cols)] = cols
+        distances[a, :len(cols)] = dists
+        neighbor_docs[a, :len(cols)] = docs
+
+    incremental = previous is not None and changed_cases is not None
+    if incremental:
+        prev_pos = {c: i for i, c in enumerate(previous["case_ids"])}
+        case_pos = {c: i for i, c in enumerate(case_ids)}
+        doc_pos = {d: i for i, d in enumerate(sorted_doc_ids)}
+        changed_cols = np.array(sorted(case_pos[c] for c in changed_cases if c in case_pos), dtype=np.int64)
+
+    recomputed = 0
+    for a, case_id in enumerate(case_ids):
+        if not incremental or case_id in changed_cases or case_id not in prev_pos:
+            fill(a, *_case_row(a, starts, counts, vectors, k))
+            recomputed += 1
+            continue
+
+        # 変更のない事例: 前回の近傍から変更事例を除き、変更事例との距離を計算して合流させる
+        p = prev_pos[case_id]
+        merged = {}
+        dropped = False  # 前回の近傍から変更・削除された事例を除いたか
+        prev_kth = -np.inf  # 前回の k 番目 (最も遠い近傍) の距離
+        for b_prev, dist, doc_prev in zip(previous["neighbors"][p], previous["distances"][p], previous["neighbor_docs"][p]):
+            if b_prev < 0:
+                continue
+            prev_kth = max(prev_kth, float(dist))
+            b_case = previous["case_ids"][b_prev]
+            doc_id = previous["doc_ids"][doc_prev]
+            if b_case in changed_cases or b_case not in case_pos or doc_id not in doc_pos:
+                dropped = True
+                continue
+            merged[case_pos[b_case]] = (float(dist), doc_pos[doc_id])
+        if len(changed_cols):
+            cols, dists, docs = _case_row(a, starts, counts, vectors, k, columns=changed_cols)
+            for b, dist, doc in zip(cols, dists, docs):
+                merged[int(b)] = (float(dist), int(doc))
+        if dropped:
+            # 前回 k+1 番目以降だった変更のない事例は前回の k 番目より遠いことしか分からないので、
+            # 信用できるのは前回の k 番目の距離以内の候補だけ
+            merged = {b: v for b, v in merged.items() if v[0] <= prev_kth}
+
+        if len(merged) < k:
+            # 近傍が足りない行は全件から計算し直す
+            fill(a, *_case_row(a, starts, counts, vectors, k))
+            recomputed += 1
+            continue
+        top = sorted(merged.items(), key=lambda item: item[1][0])[:k]
+        fill(
+            a,
+            np.array([b for b, _ in top]),
+            np.array([d for _, (d, _) in top]),
+            np.array([doc for _, (_, doc) in top]),
+        )
+
+    logging.info(f"[SimilarCases] {n_cases} 事例中 {recomputed} 行を全件計算しました。")
+    return {
+        "case_ids": case_ids,
+        "doc_ids": sorted_doc_ids,
+        "neighbors": neighbors,
+        "distances": distances.astype(np.float16),
+        "neighbor_docs": neighbor_docs,
+    }
+
+
+def save_similar_cases(graph: dict, path: Path) -> None:
+    tmp_path = Path(str(path) + ".tmp.npz")
+    np.savez_compressed(tmp_path, **graph)
+    os.replace(tmp_path, path)
+
+
+def load_similar_cases(path: Path) -> dict | None:
+    if not Path(path).exists():
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return {key: data[key] for key in data.files}
+    except Exception as e:
+        logging.error(f"[SimilarCases] 読み込みに失敗しました: {e}")
+        return None
+
+
+class SimilarCasesTable:
+    """読み込んだ近傍グラフから、事例ごとの類似事例を引く。"""
+
+    def __init__(self, graph: dict):
+        self.graph = graph
+        self.k = graph["neighbors"].shape[1]
+        self._case_pos = {c: i for i, c in enumerate(graph["case_ids"].tolist())}
+
+    @property
+    def complete(self) -> bool:
+        """全事例との距離を保持しているか (事例数が K 以下の場合)。"""
+        return self.k >= len(self.graph["case_ids"]) - 1
+
+    def __contains__(self, case_id: str) -> bool:
+        return case_id in self._case_pos
+
+    def lookup(self, case_id: str, n_results: int) -> list[tuple[str, str, float]]:
+        """(類似事例の case_id, 代表ドキュメントID, 距離) を距離昇順で返す。"""
+        a = self._case_pos.get(case_id)
+        if a is None:
+            return []
+        results = []
+        for b, doc, dist in zip(
+            self.graph["neighbors"][a][:n_results],
+            self.graph["neighbor_docs"][a][:n_results],
+            self.graph["distances"][a][:n_results],
+        ):
+            if b < 0:
+                break
+            results.append((str(self.graph["case_ids"][b]), str(self.graph["doc_ids"][doc]), float(dist)))
+        return results
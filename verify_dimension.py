@@ -0,0 +1,46 @@
+"""
+Embedding の次元を切り詰めた (EMBEDDING_DIMENSION) 場合の再現率を、現在のインデックスの次元と比べて確認する。
+保存済みのベクトルを先頭から切り詰めて正規化し直すだけなので、Embedding API は呼ばない。
+
+    python verify_dimension.py [クエリ数] [k]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from search import NumpyIndex, fit_dimension, load_index_data
+from verify_quantization import recall_at_k
+
+DIMENSIONS = [128, 256, 512, 768, 1536]
+
+
+def verify(n_queries: int = 200, k: int = 30):
+    data = load_index_data()
+    if not data or not data["ids"]:
+        print("FAIL: インデックスが見つかりません。先に rebuild_index.py を実行してください。")
+        return
+
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    meta = (data["ids"], data["documents"], data["metadatas"])
+    full = NumpyIndex(*meta, vectors, quantization="float32")
+    rng = np.random.default_rng(0)
+    rows = rng.choice(full.count(), size=min(n_queries, full.count()), replace=False)
+    truth, _ = full.topk(vectors[rows], k)
+
+    print(f"{full.count()} 件, 次元 {vectors.shape[1]}, クエリ {len(rows)} 件, k={k}")
+    for dim in [d for d in DIMENSIONS if d < vectors.shape[1]]:
+        truncated = np.asarray(fit_dimension(vectors.tolist(), dim), dtype=np.float32)
+        index = NumpyIndex(*meta, truncated, quantization="float32")
+        start = time.perf_counter()
+        found, _ = index.topk(truncated[rows], k)
+        elapsed = (time.perf_counter() - start) * 1000 / len(rows)
+        print(
+            f"{dim:5} 次元: {index.vectors.nbytes / 1e6:8.2f} MB, "
+            f"recall@{k} = {recall_at_k(truth, found):.4f}, {elapsed:.2f} ms/query"
+        )
+
+
+if __name__ == "__main__":
+    verify(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,71 @@
+"""
+コールドスタート (新しいプロセス) での import 時間と、一覧表示の最初のページを返すまでの時間を計測する。
+一覧表示だけなら chromadb と google.generativeai を読み込まないことも確認する。
+計測ごとに新しい Python プロセスを起動するので、モジュールのキャッシュの影響を受けない。
+
+    python verify_import_time.py [回数]
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+HEAVY_MODULES = ["chromadb", "google.generativeai"]
+
+# 子プロセスで実行し、経過時間 (ms) と読み込まれた重い SDK を JSON で出力する
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{body}
+print(json.dumps({{
+    "ms": (time.perf_counter() - start) * 1000,
+    "heavy": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+CASES = {
+    "import chromadb": "import chromadb",
+    "import google.generativeai": "import google.generativeai",
+    "import search": "import search",
+    "一覧表示の1ページ目": (
+        "import search\n"
+        "engine = search.SearchEngine()\n"
+        "search.get_index_readiness().check()\n"
+        "cursor = engine.browse_cursor()\n"
+        "page = engine.search_page(cursor['cursor'], 0, 24)\n"
+        "assert page['results'] or not cursor['total']"
+    ),
+}
+
+
+def probe(body: str) -> dict:
+    code = _PROBE.format(body=body, heavy=HEAVY_MODULES)
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parent, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def verify(repeat: int = 3):
+    ok = True
+    for name, body in CASES.items():
+        try:
+            runs = [probe(body) for _ in range(repeat)]
+        except subprocess.CalledProcessError as e:
+            print(f"FAIL: {name}: {e.stderr.strip().splitlines()[-1] if e.stderr else e}")
+            ok = False
+            continue
+        median = statistics.median(r["ms"] for r in runs)
+        heavy = runs[0]["heavy"]
+        print(f"{name:28}: {median:8.1f} ms (中央値, {repeat} 回)  読み込まれた SDK: {heavy or 'なし'}")
+        if heavy and name not in [f"import {m}" for m in HEAVY_MODULES]:
+            print(f"FAIL: {name} で {', '.join(heavy)} が読み込まれています")
+            ok = False
+    print("OK" if ok else "FAIL")
+
+
+if __name__ == "__main__":
+    verify(*(int(a) for a in sys.argv[1:2]))
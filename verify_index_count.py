@@ -1,12 +1,9 @@
 
 import chromadb
-from pathlib import Path
 import json
 
-DATA_DIR = Path("c:/Users/jonso/.gemini/office/data")
-CHROMA_DIR = DATA_DIR / "chroma_db_v2"
-ENRICHED_DATA_PATH = DATA_DIR / "enriched_data.json"
-COLLECTION_NAME = "komatsu_cases"
+import search
+from search import CHROMA_DIR, ENRICHED_DATA_PATH
 
 
 def verify_count():
@@ -20,7 +17,8 @@ def verify_count():
     # 2. Check ChromaDB Index
     client = chromadb.PersistentClient(path=str(CHROMA_DIR))
     try:
-        collection = client.get_collection(COLLECTION_NAME)
+        # 構築ごとに版付きのコレクション (komatsu_cases_v<版>) ができるので、現在の版のポインタから名前を引く
+        collection = client.get_collection(search.active_collection_name(search.read_active_index()))
         count = collection.count()
         output.append(f"ChromaDB Index Count: {count}")
         
@@ -1,32 +1,6 @@
 import json
-import re
 
-def filter_products(description, all_products):
-    refined_products = []
-    # Normalize description for better matching (optional, depends on data)
-    desc_normalized = description.lower()
-    
-    for product in all_products:
-        # Simple inclusion check. 
-        # Could be improved with regex to avoid partial matches if needed, 
-        # but Japanese product names are often specific enough.
-        # We might need to handle variations like "マイティ-70" vs "マイティ70" if they exist in text.
-        # For now, let's try direct matching and see.
-        
-        # Remove whitespace and hyphens for flexible matching? 
-        # Or stick to exact match first. Enriched data has "マイティ-70".
-        # Let's try exact match first.
-        if product in description:
-            refined_products.append(product)
-            continue
-            
-        # Try a slightly more flexible match (remove hyphens)
-        prod_normalized = product.replace("-", "").replace(" ", "")
-        if prod_normalized in desc_normalized.replace("-", "").replace(" ", ""):
-             refined_products.append(product)
-
-    # Remove duplicates while preserving order
-    return list(dict.fromkeys(refined_products))
+from product_matcher import ProductMatcher
 
 def verify():
     # Load actual data
@@ -41,11 +15,12 @@ def verify():
 
     case_products = target_case["products"]
     print(f"Case Products ({len(case_products)}): {case_products}")
+    matcher = ProductMatcher(case_products)
     
     for i, desc_entry in enumerate(target_case.get("descriptions", [])[:5]): # Check first 5 images
         desc = desc_entry.get("description", "")
         print(f"\n--- Image {i} ---")
-        filtered = filter_products(desc, case_products)
+        filtered = matcher.find(desc)
         print(f"Filtered ({len(filtered)}): {filtered}")
         # print(f"Description snippet: {desc[:100]}...")
 
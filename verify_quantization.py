@@ -0,0 +1,52 @@
+"""
+量子化 (float16 / int8) した NumPy バックエンドの再現率を、float32 の厳密検索と比べて確認する。
+クエリには登録済みドキュメントのベクトルを使うので、Embedding API は呼ばない。
+
+    python verify_quantization.py [クエリ数] [k]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from search import NumpyIndex, load_index_data
+
+MODES = [("float16", 0), ("float16", 4), ("int8", 0), ("int8", 4)]
+
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / truth.size
+
+
+def verify(n_queries: int = 200, k: int = 30):
+    data = load_index_data()
+    if not data or not data["ids"]:
+        print("FAIL: インデックスが見つかりません。先に rebuild_index.py を実行してください。")
+        return
+
+    args = (data["ids"], data["documents"], data["metadatas"], data["embeddings"])
+    exact = NumpyIndex(*args, quantization="float32")
+    rng = np.random.default_rng(0)
+    rows = rng.choice(exact.count(), size=min(n_queries, exact.count()), replace=False)
+    queries = np.asarray(data["embeddings"], dtype=np.float32)[rows]
+    truth, _ = exact.topk(queries, k)
+
+    print(f"{exact.count()} 件, 次元 {exact.vectors.shape[1]}, クエリ {len(rows)} 件, k={k}")
+    print(f"float32         : {exact.vectors.nbytes / 1e6:8.2f} MB")
+    for mode, rerank in MODES:
+        index = NumpyIndex(*args, quantization=mode, rerank_factor=rerank, int8=data.get("int8"))
+        start = time.perf_counter()
+        found, _ = index.topk(queries, k)
+        elapsed = (time.perf_counter() - start) * 1000 / len(rows)
+        nbytes = index.vectors.nbytes + (index._scales.nbytes if index._scales is not None else 0)
+        label = f"{mode} rerank x{rerank}" if rerank else mode
+        print(
+            f"{label:16}: {nbytes / 1e6:8.2f} MB, recall@{k} = {recall_at_k(truth, found):.4f}, "
+            f"{elapsed:.2f} ms/query"
+        )
+
+
+if __name__ == "__main__":
+    verify(*(int(a) for a in sys.argv[1:3]))
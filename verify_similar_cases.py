@@ -0,0 +1,81 @@
+"""
+類似事例表の差分更新 (build_similar_cases に previous / changed_cases を渡す) が、全件計算と同じ結果になるか確認する。
+現在のインデックスのベクトルを使い、毎回いくつかの事例のベクトルを動かす・事例を削除する・事例を追加する変更を加えて
+差分更新を繰り返し、各回で全件計算と比べる。Embedding API は呼ばない。
+
+    python verify_similar_cases.py [回数] [k]
+"""
+
+import sys
+
+import numpy as np
+
+from search import load_index_data
+from similar_cases import build_similar_cases
+
+# 各回で変更する事例の数 (ベクトルを動かす・削除する・追加する)
+N_MOVED, N_DELETED, N_ADDED = 3, 1, 1
+# float16 で保存した距離の丸め誤差として許す差
+TOLERANCE = 2e-3
+
+
+def _mutate(ids, metas, vectors, rng, round_no):
+    """事例単位の変更を加えたデータと、変更した事例の集合を返す。"""
+    cases = sorted({m["case_id"] for m in metas})
+    picked = rng.choice(len(cases), size=min(N_MOVED + N_DELETED, len(cases)), replace=False)
+    moved = {cases[i] for i in picked[:N_MOVED]}
+    deleted = {cases[i] for i in picked[N_MOVED:]}
+
+    keep = [i for i, m in enumerate(metas) if m["case_id"] not in deleted]
+    ids = [ids[i] for i in keep]
+    metas = [metas[i] for i in keep]
+    vectors = vectors[keep].copy()
+    for i, m in enumerate(metas):
+        if m["case_id"] in moved:
+            vectors[i] = rng.standard_normal(vectors.shape[1])
+
+    added = set()
+    for j in range(N_ADDED):
+        case_id = f"new{round_no}_{j}"
+        added.add(case_id)
+        # 既存の画像の近くに置き、どこかの事例の近傍に入るようにする
+        source = vectors[rng.integers(len(vectors))]
+        ids.append(f"{case_id}:{case_id}_0.jpg")
+        metas.append({"case_id": case_id})
+        vectors = np.vstack([vectors, source + 0.05 * rng.standard_normal(vectors.shape[1])])
+    return ids, metas, vectors, moved | deleted | added
+
+
+def verify(rounds: int = 5, k: int = 20):
+    data = load_index_data()
+    if not data or not data["ids"]:
+        print("FAIL: インデックスが見つかりません。先に rebuild_index.py を実行してください。")
+        return
+
+    rng = np.random.default_rng(0)
+    ids, metas = list(data["ids"]), [dict(m) for m in data["metadatas"]]
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    previous = build_similar_cases(ids, metas, vectors, k=k)
+    print(f"{len(ids)} 件, {len(previous['case_ids'])} 事例, k={k}, {rounds} 回")
+
+    ok = True
+    for round_no in range(1, rounds + 1):
+        ids, metas, vectors, changed = _mutate(ids, metas, vectors, rng, round_no)
+        incremental = build_similar_cases(ids, metas, vectors, k=k, previous=previous, changed_cases=changed)
+        full = build_similar_cases(ids, metas, vectors, k=k)
+
+        diff = np.abs(incremental["distances"].astype(np.float32) - full["distances"].astype(np.float32))
+        wrong = np.flatnonzero((diff > TOLERANCE).any(axis=1))
+        reordered = np.setdiff1d(np.flatnonzero((incremental["neighbors"] != full["neighbors"]).any(axis=1)), wrong)
+        print(f"{round_no} 回目: 変更 {len(changed)} 事例, 距離が違う行 {len(wrong)}, 並びだけ違う行 {len(reordered)}")
+        for a in wrong[:3]:
+            names = lambda g: [str(g["case_ids"][b]) for b in g["neighbors"][a] if b >= 0]
+            print(f"  {full['case_ids'][a]}: 差分 {names(incremental)} / 全件 {names(full)}")
+        ok &= len(wrong) == 0
+        previous = incremental  # 差分更新の結果を次の回の前回分にして、誤差が積み重ならないか見る
+
+    print("OK" if ok else "FAIL")
+
+
+if __name__ == "__main__":
+    verify(*(int(a) for a in sys.argv[1:3]))